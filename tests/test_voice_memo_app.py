@@ -1,6 +1,18 @@
 # 音声メモアプリの自動テスト
 import pytest
 import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+
+@pytest.fixture(scope="module")
+def app():
+    """アプリ本体を読み込む（streamlit が無い環境ではスキップ）"""
+    pytest.importorskip("streamlit")
+    import voice_memo_app
+    return voice_memo_app
 
 class TestBasic:
     """基本的なテスト"""
@@ -24,5 +36,190 @@ class TestBasic:
         ]
         assert len(sections) == 3
 
+
+class TestNaturalSort:
+    """音声ファイルの並び順のテスト"""
+
+    def test_extension_digits_are_ignored(self, app):
+        names = ["meeting 3.mp3", "meeting.mp3", "meeting 2.mp3"]
+        assert sorted(names, key=app._natural_key) == ["meeting.mp3", "meeting 2.mp3", "meeting 3.mp3"]
+
+    def test_digit_runs_compare_as_separate_integers(self, app):
+        assert sorted(["rec_10_1.mp3", "rec_2_10.mp3"], key=app._natural_key) == ["rec_2_10.mp3", "rec_10_1.mp3"]
+
+    def test_numbers_compare_numerically(self, app):
+        names = ["talk10.m4a", "talk2.m4a", "intro.m4a", "talk1.m4a"]
+        assert sorted(names, key=app._natural_key) == ["intro.m4a", "talk1.m4a", "talk2.m4a", "talk10.m4a"]
+
+    def test_audio_sort_key_uses_file_name(self, app):
+        class F:
+            def __init__(self, name):
+                self.name = name
+        files = [F("part 10.webm"), F("part 9.webm")]
+        assert [f.name for f in sorted(files, key=app._audio_sort_key)] == ["part 9.webm", "part 10.webm"]
+
+
+class TestMergeOverlapping:
+    """チャンク境界の重複除去のテスト"""
+
+    def test_exact_overlap_is_removed(self, app):
+        merged = app.merge_overlapping(["今日は会議の議題を確認します", "議題を確認します。次に予算です"])
+        assert merged == "今日は会議の議題を確認します。次に予算です"
+
+    def test_fuzzy_overlap_is_removed(self, app):
+        # 境界の揺れ（前チャンク末尾の「ね」、次チャンク先頭の「えー」）で完全一致しない場合
+        merged = app.merge_overlapping(["今日は会議の議題を確認しますね", "えー議題を確認します。次に予算です"])
+        assert merged == "今日は会議の議題を確認します。次に予算です"
+
+    def test_no_overlap_is_joined_with_space(self, app):
+        assert app.merge_overlapping(["前半の話", "後半の話"]) == "前半の話 後半の話"
+
+    def test_word_tokens_keep_spacing(self, app):
+        assert app.merge_overlapping(["hello world foo", "world foo bar"]) == "hello world foo bar"
+
+    def test_blank_chunks_are_skipped(self, app):
+        assert app.merge_overlapping(["", "a", "  "]) == "a"
+
+
+class TestChunkWindows:
+    """分割窓のテスト"""
+
+    def test_windows_overlap_by_three_seconds(self, app):
+        assert app._chunk_windows(100.0, [40.0, 75.0]) == [(0.0, 43.0), (40.0, 38.0), (75.0, 28.0)]
+
+    def test_no_cuts_gives_single_window(self, app):
+        assert app._chunk_windows(10.0, []) == [(0.0, 13.0)]
+
+
+class TestDiskCache:
+    """ディスクキャッシュの掃除のテスト"""
+
+    def test_put_sweeps_expired_and_caps_entries(self, app, monkeypatch, tmp_path):
+        monkeypatch.setattr(app, "DISK_CACHE_DIR", tmp_path)
+        monkeypatch.setattr(app, "DISK_CACHE_ENABLED", True)
+        monkeypatch.setattr(app, "DISK_CACHE_MAX_ENTRIES", 2)
+        old = app._disk_path("old")
+        old.write_text('{"t": 0, "v": "x"}', encoding="utf-8")
+        os.utime(old, (0, 0))
+        now = time.time()
+        for i, key in enumerate(["a", "b", "c"]):
+            app._disk_put(key, key)
+            os.utime(app._disk_path(key), (now - 10 + i, now - 10 + i))
+        app._disk_sweep()
+        assert not old.exists()
+        assert sorted(p.name for p in tmp_path.glob("*.json")) == sorted(
+            app._disk_path(k).name for k in ["b", "c"]
+        )
+
+
+class TestSplitAndTranscribe:
+    """チャンク単位の失敗処理のテスト"""
+
+    def test_extract_failure_keeps_other_chunks(self, app, monkeypatch, tmp_path):
+        import asyncio
+        import subprocess
+        src = tmp_path / "memo.ogg"
+        src.write_bytes(b"x")
+
+        async def fake_extract(input_path, start, length, output_chunk):
+            if start == 40.0:
+                raise subprocess.CalledProcessError(1, ["ffmpeg"])
+            with open(output_chunk, "wb") as f:
+                f.write(str(start).encode())
+            return True
+
+        class FakeClient:
+            def __init__(self, **kwargs):
+                self.audio = self
+
+            @property
+            def transcriptions(self):
+                return self
+
+            async def create(self, file, **kwargs):
+                return f"chunk@{file.read().decode()}"
+
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *exc):
+                return False
+
+        class FakeProgress:
+            def progress(self, value):
+                pass
+
+        warnings = []
+        monkeypatch.setattr(app, "_find_silence_cuts", lambda path, duration: [40.0, 75.0])
+        monkeypatch.setattr(app, "_extract_chunk", fake_extract)
+        monkeypatch.setattr(app, "AsyncOpenAI", FakeClient)
+        monkeypatch.setattr(app.st, "warning", warnings.append)
+
+        texts, complete = asyncio.run(
+            app._split_and_transcribe_async(str(src), 100.0, "sk-test", FakeProgress())
+        )
+        assert texts == ["chunk@0.0", "chunk@75.0"]
+        assert not complete
+        assert len(warnings) == 1 and "チャンク2" in warnings[0]
+
+
+class TestReportMarkmap:
+    """レポートとMarkmapの分離のテスト"""
+
+    def test_marker_split_across_deltas_is_hidden(self, app):
+        parts = []
+        shown = "".join(app._hide_after_marker(["レポ", "ート<!-- MAR", "KMAP -->\n# 見出し"], parts))
+        assert shown == "レポート"
+        assert "".join(parts) == "レポート<!-- MARKMAP -->\n# 見出し"
+
+    def test_without_marker_everything_is_shown(self, app):
+        parts = []
+        assert "".join(app._hide_after_marker(["本文", "の続き"], parts)) == "本文の続き"
+
+    def test_split_report_markmap(self, app):
+        assert app.split_report_markmap("本文\n\n<!-- MARKMAP -->\n# a\n") == ("本文", "# a")
+        assert app.split_report_markmap("本文のみ") == ("本文のみ", None)
+
+
+class TestTextCompression:
+    """トークン切り詰めと抽出型圧縮のテスト"""
+
+    def test_short_text_is_unchanged(self, app):
+        text = "一文目です。二文目です。"
+        assert app.truncate_tokens(text, 1000) == text
+
+    def test_truncation_snaps_to_sentence_end(self, app, monkeypatch):
+        # tiktoken なし（1文字＝1トークン扱い）で、途中の文で切れたら直前の「。」まで戻る
+        monkeypatch.setattr(app, "_token_encoder", lambda: None)
+        assert app.truncate_tokens("一文目です。二文目です。\n三文目です。", 8) == "一文目です。"
+
+    def test_extractive_compress_keeps_informative_sentences(self, app):
+        text = "えーと今日は天気です。予算は300万円に決定しました。あのーそれでは。"
+        assert app.extractive_compress(text, 20) == "予算は300万円に決定しました。"
+
+    def test_extractive_compress_keeps_original_order(self, app):
+        text = "担当はAliceです。雑談です。期限は3月です。"
+        assert app.extractive_compress(text, 100).split("\n") == ["担当はAliceです。", "雑談です。", "期限は3月です。"]
+
+
+class TestSummaryHtml:
+    """構造化サマリーHTMLのテスト"""
+
+    def test_missing_fields_use_defaults(self, app):
+        page = app.summary_to_html({"actions": [{"what": "資料送付"}], "flow": [{}]}, ["a.mp3"], "now")
+        assert "🟡 緊急度：中" in page
+        assert "👤 未定" in page and "📅 期限未定" in page
+
+    def test_values_are_escaped(self, app):
+        page = app.summary_to_html({"title": "<script>x</script>"}, ["<b>.mp3"], "now")
+        assert "<script>x" not in page
+        assert "&lt;script&gt;x&lt;/script&gt;" in page and "&lt;b&gt;.mp3" in page
+
+    def test_actions_sorted_by_priority(self, app):
+        data = {"actions": [{"priority": "低", "what": "後で"}, {"priority": "高", "what": "先に"}]}
+        page = app.summary_to_html(data, ["a.mp3"], "now")
+        assert page.index("先に") < page.index("後で")
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
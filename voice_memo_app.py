@@ -1,12 +1,32 @@
 import streamlit as st
 import tempfile
+import io
 import os
 import re
+import shutil
 import json
+import hashlib
+import base64
+import gzip
+import html
+import importlib.util
+import time
+import threading
+import zipfile
 from pathlib import Path
 from datetime import datetime
 import subprocess
-from openai import OpenAI
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextlib
+import difflib
+import functools
+import random
+from typing import Literal
+from openai import OpenAI, AsyncOpenAI, RateLimitError, APIConnectionError, InternalServerError
+from packaging.version import Version
+from pydantic import BaseModel, Field
+import httpx
 import requests
 
 try:
@@ -46,18 +66,219 @@ NOTION_DB_KENSHU   = os.environ.get("NOTION_DB_ID_KENSHU", "475162c3cf1f4993a9b2
 # ═══════════════════════════════════════════
 MAX_TRANSCRIPT_CHARS = 12000   # GPTに送る文字起こしの上限
 MAX_MATERIAL_CHARS   = 3000    # 資料テキストの上限
-MAX_REPORT_CHARS     = 4000    # サマリー生成時のレポートの上限
+MAX_REPORT_TOKENS    = 4000    # サマリー生成時のレポートの上限（トークン）
+SUMMARY_TRANSCRIPT_TOKENS = 6000   # サマリー生成時の文字起こしの上限（トークン）
+SUMMARY_MATERIAL_TOKENS   = 1500   # サマリー生成時の資料の上限（トークン）
+
+
+# ═══════════════════════════════════════════
+# キャッシュ用キー
+# ═══════════════════════════════════════════
+REPORT_MODEL   = "gpt-4o"
+FAST_REPORT_MODEL = "gpt-4o-mini"   # 高速モード用（料金・待ち時間とも大幅に小さい）
+REPORT_MAX_TOKENS = 3800            # レポート＋Markmap出力の上限（出力トークン数が待ち時間を決める）
+TRANSCRIBE_MODEL = "gpt-4o-transcribe"
+PROMPT_VERSION = "v2"   # プロンプトを変えたら上げる（古いキャッシュを無効化）
+CACHE_TTL_SEC  = 3600
+
+
+def _http2_available() -> bool:
+    """httpx の HTTP/2 は h2 パッケージが入っている場合だけ有効にできる"""
+    return importlib.util.find_spec("h2") is not None
+
+
+@st.cache_resource
+def get_openai(api_key: str) -> OpenAI:
+    """APIキーごとに1つのクライアントを使い回す（再実行のたびにTLS接続を張り直さない）"""
+    return OpenAI(
+        api_key=api_key,
+        http_client=httpx.Client(
+            http2=_http2_available(),
+            limits=httpx.Limits(max_keepalive_connections=8, max_connections=16)
+        ),
+    )
+
+
+def _api_key_fp(api_key: str) -> str:
+    """APIキーのフィンガープリント（キャッシュをユーザーごとに分ける）"""
+    return hashlib.sha256(api_key.encode()).hexdigest()[:8]
+
+
+@st.cache_resource
+def _response_store() -> dict:
+    """APIの結果キャッシュ（プロセス内で共有: キー → (保存時刻, 値)）
+
+    ストリーミング表示する呼び出しは st.cache_data で記録できないため、ここに保存する。
+    """
+    return {}
+
+
+# ディスクキャッシュ（プロセス再起動後も同じ入力でAPIを呼び直さない）。
+# 会議の内容を平文で残すため既定では無効で、VOICE_MEMO_DISK_CACHE=1 で有効にする
+DISK_CACHE_DIR = Path(os.environ.get("VOICE_MEMO_CACHE_DIR", "~/.cache/voice_memo")).expanduser()
+DISK_CACHE_ENABLED = os.environ.get("VOICE_MEMO_DISK_CACHE", "0") == "1"
+DISK_CACHE_TTL_SEC = 7 * 24 * 3600
+DISK_CACHE_MAX_ENTRIES = 256
+
+
+def _disk_path(key: str) -> Path:
+    return DISK_CACHE_DIR / f"{hashlib.sha256(key.encode()).hexdigest()}.json"
+
+
+def _disk_get(key: str) -> str | None:
+    if not DISK_CACHE_ENABLED:
+        return None
+    path = _disk_path(key)
+    try:
+        with open(path, encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - entry.get("t", 0) >= DISK_CACHE_TTL_SEC:
+        path.unlink(missing_ok=True)
+        return None
+    return entry.get("v")
+
+
+def _disk_sweep() -> None:
+    """期限切れのエントリを消し、残りも新しい順に DISK_CACHE_MAX_ENTRIES 件までに抑える。
+
+    同じキーが二度と読まれないエントリ（一度きりの録音など）も期限で消えるよう、書き込みのたびに実行する。
+    """
+    now = time.time()
+    entries = []
+    for path in DISK_CACHE_DIR.glob("*.json"):
+        try:
+            mtime = path.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        if now - mtime >= DISK_CACHE_TTL_SEC:
+            path.unlink(missing_ok=True)
+        else:
+            entries.append((mtime, path))
+    entries.sort(reverse=True)
+    for _, path in entries[DISK_CACHE_MAX_ENTRIES:]:
+        path.unlink(missing_ok=True)
+
+
+def _disk_put(key: str, value: str) -> None:
+    if not DISK_CACHE_ENABLED:
+        return
+    path = _disk_path(key)
+    try:
+        DISK_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"t": time.time(), "v": value}, f, ensure_ascii=False)
+        os.replace(tmp, path)   # 書きかけのファイルを読ませない
+        _disk_sweep()
+    except OSError:
+        pass   # 読み取り専用環境などではメモリ上のキャッシュだけで続ける
+
+
+def _store_get(key: str) -> str | None:
+    hit = _response_store().get(key)
+    if hit and time.time() - hit[0] < CACHE_TTL_SEC:
+        return hit[1]
+    value = _disk_get(key)
+    if value is not None:
+        _store_put(key, value, persist=False)
+    return value
+
+
+def _store_put(key: str, value: str, max_entries: int = 64, persist: bool = True) -> None:
+    store = _response_store()
+    store[key] = (time.time(), value)
+    while len(store) > max_entries:   # 古いものから捨てる（dictは挿入順）
+        store.pop(next(iter(store)), None)
+    if persist:
+        _disk_put(key, value)
+
+
+def _file_digest(path) -> str:
+    """ファイル内容のSHA-256（1MB単位で読み込み）"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+@functools.lru_cache(maxsize=1)
+def _token_encoder():
+    """gpt-4o のトークナイザ（tiktoken が無ければ None）。読み込みは初回だけ"""
+    try:
+        import tiktoken  # optional dependency
+        return tiktoken.encoding_for_model("gpt-4o")
+    except Exception:
+        return None
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """text を max_tokens トークン以内に切り詰め、最後の「。」か改行で区切る
+
+    日本語は1文字あたりのトークン数が一定でないので、文字数ではなくトークン数で切る。
+    tiktoken が無い場合は1文字≒1トークンとみなして文字数で切る。
+    """
+    enc = _token_encoder()
+    if enc is None:
+        trimmed = text[:max_tokens]
+    else:
+        tokens = enc.encode(text)
+        if len(tokens) <= max_tokens:
+            return text
+        trimmed = enc.decode(tokens[:max_tokens])
+    if len(trimmed) == len(text):
+        return text
+    cut = max(trimmed.rfind("。"), trimmed.rfind("\n"))
+    # 区切りが極端に前にしかない場合は途中で切れても長さを優先する
+    return trimmed[:cut + 1] if cut > len(trimmed) // 2 else trimmed
+
+
+_SENTENCE_RE  = re.compile(r"[^。！？\n]+[。！？]?")
+_FILLER_RE    = re.compile(r"(?:えー+と?|えっと|あのー+|うーん|まあ)[、,\s]*")
+_DIGIT_RE     = re.compile(r"[0-9０-９]")
+_ENTITY_RE    = re.compile(r"[A-Z][A-Za-z]+|[ァ-ヴー]{3,}")
+_DECISION_RE  = re.compile(r"決定|決まり|合意|期限|締め切り|担当|次回|宿題")
+
+
+def _sentence_score(sentence: str) -> int:
+    """数字・固有名詞らしき語・決定事項のキーワードを含む文ほど高くする"""
+    return (len(_DIGIT_RE.findall(sentence)) * 3
+            + len(_ENTITY_RE.findall(sentence)) * 2
+            + (5 if _DECISION_RE.search(sentence) else 0))
+
+
+def extractive_compress(text: str, target_chars: int) -> str:
+    """APIを使わずに文単位で抽出して target_chars 以内に縮める（フィラーを除き、重要そうな文を元の順に残す）"""
+    sentences = [s.strip() for s in _SENTENCE_RE.findall(_FILLER_RE.sub("", text))]
+    sentences = [s for s in sentences if s]
+    ranked = sorted(range(len(sentences)), key=lambda i: (-_sentence_score(sentences[i]), i))
+    keep, total = set(), 0
+    for i in ranked:
+        n = len(sentences[i]) + 1
+        if total + n > target_chars:
+            continue   # 長すぎる文は飛ばして、入る文を探し続ける
+        keep.add(i)
+        total += n
+    return "\n".join(sentences[i] for i in sorted(keep))
 
 
 def compress_transcript(text: str, api_key: str) -> str:
     """
-    文字起こしが長すぎる場合、GPTで事前に要点を圧縮する。
+    文字起こしが長すぎる場合、事前に要点を圧縮する。
+    まずローカルの抽出型圧縮を使い、文に区切れずうまく縮まらない場合だけGPTで要約する。
     圧縮後は MAX_TRANSCRIPT_CHARS 以内に収める。
     """
     if len(text) <= MAX_TRANSCRIPT_CHARS:
         return text   # 短ければそのまま返す
 
-    client = OpenAI(api_key=api_key)
+    extracted = extractive_compress(text, MAX_TRANSCRIPT_CHARS)
+    if len(extracted) >= MAX_TRANSCRIPT_CHARS // 2:
+        st.info(f"📝 文字起こしを要点抽出で圧縮しました（{len(text):,}文字 → {len(extracted):,}文字）")
+        return extracted
+
+    client = get_openai(api_key)
     # 長い場合は先頭・中盤・末尾から均等にサンプリング
     third = len(text) // 3
     sampled = (
@@ -90,138 +311,646 @@ def compress_transcript(text: str, api_key: str) -> str:
 # ═══════════════════════════════════════════
 # 音声処理
 # ═══════════════════════════════════════════
+def _import_av():
+    try:
+        import av  # optional dependency
+        return av
+    except ImportError:
+        return None
+
+
+def _is_path(source) -> bool:
+    return isinstance(source, (str, os.PathLike))
+
+
+def _rewind(source):
+    """アップロードファイル（BytesIO）は読むたびに先頭へ戻す"""
+    if not _is_path(source):
+        source.seek(0)
+    return source
+
+
+# 音声向けモード＋60msフレーム（フレーム数が減りエンコードとOggのオーバーヘッドが軽くなる）
+OPUS_OPTIONS = {"application": "voip", "vbr": "on", "frame_duration": "60"}
+
+
+def _compress_audio_pyav(av, input_path, output):
+    """PyAV（libavcodec を直接呼ぶ）でプロセスを起こさずに変換。入出力はパスまたはファイルオブジェクト"""
+    with av.open(_rewind(input_path)) as src, av.open(output, "w", format="ogg") as dst:
+        out = dst.add_stream("libopus", rate=16000, layout="mono",
+                             options=OPUS_OPTIONS)
+        out.bit_rate = 16000
+        resampler = av.AudioResampler(format="s16", layout="mono", rate=16000)
+        for frame in src.decode(audio=0):
+            for rf in resampler.resample(frame):
+                dst.mux(out.encode(rf))
+        for rf in resampler.resample(None):   # リサンプラのフラッシュ
+            dst.mux(out.encode(rf))
+        dst.mux(out.encode(None))             # エンコーダのフラッシュ
+
+
+FFMPEG_QUIET = ["-loglevel", "error", "-nostats"]   # 進捗ログを出さない（エラーだけstderrへ）
+
+
+def _ffmpeg_error(e: Exception) -> str:
+    """ffmpeg の失敗は終了コードだけでは分からないので、stderr の末尾を添える"""
+    err = getattr(e, "stderr", None)
+    if isinstance(err, bytes):
+        err = err.decode(errors="replace")
+    return f"{e}\n{err.strip()[-2000:]}" if err else str(e)
+
+
+def _ffmpeg_compress_cmd(input_path, output) -> list:
+    # pipe:0 のときは標準入力から読むので -nostdin は付けられない
+    no_stdin = [] if input_path == "pipe:0" else ["-nostdin"]
+    return ["ffmpeg", *FFMPEG_QUIET, *no_stdin, "-i", input_path, "-vn", "-ac", "1", "-ar", "16000",
+            "-c:a", "libopus", "-b:a", "16k",
+            *(arg for k, v in OPUS_OPTIONS.items() for arg in (f"-{k}", v)),
+            "-f", "ogg", "-y", output]
+
+
 def compress_audio(input_path, output_path):
+    """Whisper向けにモノラル16kHz・Opus 16kbps（.ogg）へ変換
+
+    PyAV があればプロセス内で、なければ ffmpeg コマンドで変換する。
+    input_path はアップロードファイル（BytesIO）でもよく、その場合はディスクに書かずに読む。
+    """
+    av = _import_av()
     try:
-        subprocess.run(
-            ["ffmpeg", "-i", input_path, "-vn", "-ac", "1",
-             "-ar", "16000", "-b:a", "32k", "-y", output_path],
-            check=True, capture_output=True
-        )
+        if av is not None:
+            _compress_audio_pyav(av, input_path, output_path)
+        elif _is_path(input_path):
+            subprocess.run(_ffmpeg_compress_cmd(input_path, output_path), check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        else:
+            subprocess.run(_ffmpeg_compress_cmd("pipe:0", output_path),
+                           input=input_path.getvalue(), check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
         return True
     except Exception as e:
-        st.error(f"圧縮エラー: {e}")
+        st.error(f"圧縮エラー: {_ffmpeg_error(e)}")
         return False
 
 
-def split_audio(input_path, chunk_sec=600):
-    """音声を10分チャンクに分割"""
-    chunks = []
+def compress_audio_to_bytes(source) -> bytes | None:
+    """compress_audio と同じ変換をメモリ上で行い、.ogg のバイト列を返す
+
+    source はパスかアップロードファイル。アップロードファイルはディスクに書かずに読む。
+    """
+    av = _import_av()
     try:
-        # 時間を取得
-        probe = subprocess.run(
-            ["ffprobe", "-v", "error", "-show_entries", "format=duration",
-             "-of", "default=noprint_wrappers=1:nokey=1", input_path],
-            capture_output=True, text=True, check=True
-        )
-        duration = float(probe.stdout.strip())
-        num_chunks = int(duration / chunk_sec) + 1
-        
-        # 拡張子に関わらず.mp3で統一
-        base = os.path.splitext(input_path)[0]
-        
-        for i in range(num_chunks):
-            output_chunk = f"{base}_chunk{i}.mp3"
-            subprocess.run(
-                ["ffmpeg", "-i", input_path,
-                 "-ss", str(i * chunk_sec), "-t", str(chunk_sec),
-                 "-c", "copy", "-y", output_chunk],
-                check=True, capture_output=True
-            )
-            if os.path.exists(output_chunk) and os.path.getsize(output_chunk) > 1000:
-                chunks.append(output_chunk)
-        
-        return chunks
+        if av is not None:
+            buf = io.BytesIO()
+            _compress_audio_pyav(av, source, buf)
+            return buf.getvalue()
+        if _is_path(source):
+            return subprocess.run(_ffmpeg_compress_cmd(source, "pipe:1"),
+                                  check=True, capture_output=True).stdout
+        return subprocess.run(_ffmpeg_compress_cmd("pipe:0", "pipe:1"),
+                              input=source.getvalue(),
+                              check=True, capture_output=True).stdout
     except Exception as e:
-        st.error(f"分割エラー: {e}")
-        return []
+        st.error(f"圧縮エラー: {_ffmpeg_error(e)}")
+        return None
 
 
-def transcribe_audio(file_path, api_key):
-    """音声ファイルを文字起こし（大容量対応）"""
-    client = OpenAI(api_key=api_key)
-    max_size = 24 * 1024 * 1024
-    
+def _probe_duration(path) -> float:
+    """音声の長さ（秒）を取得。PyAV があればコンテナのヘッダから読み、ffprobe を起動しない
+
+    PyAV ならアップロードファイル（BytesIO）も直接読める。
+    """
+    av = _import_av()
+    if av is not None:
+        with av.open(_rewind(path)) as c:
+            if c.duration is None:
+                raise ValueError("長さを取得できません")
+            return c.duration / av.time_base
+    probe = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries", "format=duration",
+         "-of", "default=noprint_wrappers=1:nokey=1", path],
+        capture_output=True, text=True, check=True
+    )
+    return float(probe.stdout.strip())
+
+
+# API がそのまま受け付ける形式で、既にモノラル・16kHz以下・低ビットレートなら再エンコードしない
+WHISPER_READY_SUFFIXES = {".mp3", ".m4a", ".ogg", ".webm"}
+WHISPER_READY_MAX_BITRATE = 32000
+
+
+def _source_name(source) -> str:
+    return os.fspath(source) if _is_path(source) else source.name
+
+
+def _probe_audio(source) -> tuple[float | None, bool]:
+    """長さ（秒、取れなければ None）と、変換せずにAPIへ送れるかを1回のヘッダ読みで判定する
+
+    PyAV が無ければ ffprobe で長さだけ取り、常に変換する扱いにする。
+    """
+    av = _import_av()
+    if av is None:
+        try:
+            return _probe_duration(source), False
+        except Exception:
+            return None, False
+    suffix_ok = Path(_source_name(source)).suffix.lower() in WHISPER_READY_SUFFIXES
     try:
-        # ファイルサイズチェック
-        size = os.path.getsize(file_path)
-        work_path = file_path
-        
-        # 圧縮が必要な場合
-        if size > max_size:
-            st.info("  🔧 圧縮中...")
-            # 拡張子を.mp3に統一
-            base = os.path.splitext(file_path)[0]
-            comp = f"{base}_comp.mp3"
-            if not compress_audio(file_path, comp):
-                return None
-            work_path = comp
-            size = os.path.getsize(work_path)
-        
-        # まだ大きければ分割
-        if size > max_size:
-            st.info("  ✂️ 分割中...")
-            chunks = split_audio(work_path)
-            if not chunks:
-                return None
-            
-            texts = []
-            pb = st.progress(0)
-            for i, chunk in enumerate(chunks):
-                with open(chunk, "rb") as f:
-                    resp = client.audio.transcriptions.create(
-                        model="whisper-1",
-                        file=f,
-                        language="ja"
-                    )
-                    texts.append(resp.text)
-                pb.progress((i + 1) / len(chunks))
-                os.remove(chunk)
-            
-            # 圧縮ファイルを削除
-            if work_path != file_path and os.path.exists(work_path):
-                os.remove(work_path)
-            
-            return " ".join(texts).strip()
-        
-        # 通常サイズ → そのまま文字起こし
-        with open(work_path, "rb") as f:
-            resp = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=f,
-                language="ja"
-            )
-        
-        # 圧縮ファイルを削除
-        if work_path != file_path and os.path.exists(work_path):
-            os.remove(work_path)
-        
-        return resp.text
-        
+        with av.open(_rewind(source)) as c:
+            duration = c.duration / av.time_base if c.duration is not None else None
+            a = c.streams.audio[0]
+            bit_rate = a.bit_rate or c.bit_rate
+            ready = (suffix_ok and a.channels == 1 and a.sample_rate <= 16000
+                     and bool(bit_rate) and bit_rate <= WHISPER_READY_MAX_BITRATE)
+            return duration, ready
+    except Exception:
+        return None, False
+
+
+VAD_SEARCH_SEC = 30     # 目標境界の前後何秒以内で無音を探すか
+VAD_MIN_SILENCE_MS = 300
+
+
+def _nearest_silence(vad, pcm: bytes, pcm_start: float, target: float) -> float | None:
+    """16kHzモノラルPCMを30msフレームでVAD判定し、target に最も近い無音区間の中央を返す"""
+    frame_bytes = 16000 * 30 // 1000 * 2
+    min_frames = VAD_MIN_SILENCE_MS // 30
+    runs, run_start, run_len = [], None, 0
+    for i in range(0, len(pcm) - frame_bytes + 1, frame_bytes):
+        t = pcm_start + (i // 2) / 16000
+        if not vad.is_speech(pcm[i:i + frame_bytes], 16000):
+            if run_start is None:
+                run_start, run_len = t, 0
+            run_len += 1
+            continue
+        if run_start is not None and run_len >= min_frames:
+            runs.append(run_start + run_len * 0.015)
+        run_start = None
+    if run_start is not None and run_len >= min_frames:
+        runs.append(run_start + run_len * 0.015)
+    return min(runs, key=lambda c: abs(c - target)) if runs else None
+
+
+_SILENCE_END_RE = re.compile(r"silence_end: ([\d.]+) \| silence_duration: ([\d.]+)")
+
+
+def _silencedetect_cuts(path, targets: list[float]) -> list[float]:
+    """PyAV / webrtcvad が無い環境向け。ffmpeg の silencedetect で無音区間を1パスで求めて境界を寄せる"""
+    try:
+        proc = subprocess.run(
+            ["ffmpeg", "-nostdin", "-nostats", "-i", path, "-vn",
+             "-af", f"silencedetect=noise=-30dB:d={VAD_MIN_SILENCE_MS / 1000}",
+             "-f", "null", "-"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True
+        )
+    except Exception:
+        return targets
+    centres = [float(end) - float(dur) / 2
+               for end, dur in _SILENCE_END_RE.findall(proc.stderr)]
+    cuts = []
+    for target in targets:
+        near = [c for c in centres if abs(c - target) <= VAD_SEARCH_SEC]
+        cuts.append(min(near, key=lambda c: abs(c - target)) if near else target)
+    return cuts
+
+
+def _find_silence_cuts(path, duration: float, chunk_sec=600) -> list[float]:
+    """chunk_sec ごとの目標境界を、その前後 VAD_SEARCH_SEC 秒で最も近い無音位置に寄せる。
+
+    PyAV と webrtcvad があれば境界付近だけをシークしてデコードし VAD で判定する（全体のデコードは不要）。
+    無ければ ffmpeg の silencedetect で代用する。無音が見つからない場合は固定境界のまま。
+    """
+    targets = [float(i * chunk_sec) for i in range(1, int(duration / chunk_sec) + 1)]
+    if not targets:
+        return targets
+    try:
+        import av        # optional dependency
+        import webrtcvad  # optional dependency
+    except ImportError:
+        return _silencedetect_cuts(path, targets)
+
+    vad = webrtcvad.Vad(2)
+    cuts = []
+    try:
+        with av.open(path) as container:
+            for target in targets:
+                container.seek(int((target - VAD_SEARCH_SEC) * av.time_base))
+                resampler = av.AudioResampler(format="s16", layout="mono", rate=16000)
+                pcm, pcm_start = bytearray(), None
+                for frame in container.decode(audio=0):
+                    if frame.time is None:
+                        continue
+                    if pcm_start is None:
+                        pcm_start = frame.time
+                    for rf in resampler.resample(frame):
+                        pcm += bytes(rf.planes[0])[:rf.samples * 2]
+                    if frame.time > target + VAD_SEARCH_SEC:
+                        break
+                cut = _nearest_silence(vad, bytes(pcm), pcm_start or 0.0, target)
+                cuts.append(cut if cut is not None else target)
+    except Exception:
+        return targets
+    return cuts
+
+
+def _chunk_windows(duration: float, cuts: list[float], overlap=3) -> list[tuple[float, float]]:
+    """切れ目から切り出し窓 (開始秒, 長さ秒) を作る。境界の語落ち対策で各窓の末尾を overlap 秒重ねる"""
+    starts = [0.0] + cuts
+    ends = cuts + [duration]
+    return [(round(a, 2), round(b - a + overlap, 2)) for a, b in zip(starts, ends) if b > a]
+
+
+async def _extract_chunk(input_path, start, length, output_chunk) -> bool:
+    """1チャンクを -c copy で切り出す（segment muxer は重なりを作れないため窓ごとに実行）"""
+    cmd = ["ffmpeg", *FFMPEG_QUIET, "-nostdin", "-ss", str(start), "-i", input_path,
+           "-t", str(length), "-c", "copy", "-y", output_chunk]
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+    _, err = await proc.communicate()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=err)
+    try:
+        if os.stat(output_chunk).st_size > 1000:
+            return True
+        os.unlink(output_chunk)   # 末尾の極小チャンクは捨てる
+    except FileNotFoundError:
+        pass
+    return False
+
+
+_MERGE_TOKEN_RE = re.compile(r"[A-Za-z0-9]+|\S")   # 英数字は単語、それ以外は1文字単位
+MERGE_MAX_TOKENS = 40
+MERGE_FUZZY_MIN  = 6   # 完全一致しない時、共通部分列を重なりとみなす最小トークン数
+MERGE_FUZZY_SLACK = 8  # 共通部分列が前チャンク末尾・次チャンク先頭からこのトークン数以内にあること
+
+
+def _append_rest(merged: str, rest: str) -> str:
+    # 重複除去後は元テキストの区切り（空白の有無）をそのまま引き継ぐ
+    if not rest.strip():
+        return merged
+    return f"{merged}{' ' if rest[0].isspace() else ''}{rest.lstrip()}"
+
+
+def merge_overlapping(texts: list[str]) -> str:
+    """オーバーラップ付きチャンクの文字起こしを結合する。
+
+    前チャンク末尾と次チャンク先頭で一致する最長のトークン列（最大 MERGE_MAX_TOKENS）を
+    重複とみなし、次チャンク側から取り除く。境界付近の認識揺れで完全一致しない場合は、
+    difflib で末尾・先頭付近の最長共通部分列を探し、その終わりでつなぐ。
+    """
+    merged = ""
+    for text in texts:
+        text = text.strip()
+        if not text:
+            continue
+        if not merged:
+            merged = text
+            continue
+        offset = max(0, len(merged) - 400)
+        tail_matches = list(_MERGE_TOKEN_RE.finditer(merged, offset))[-MERGE_MAX_TOKENS:]
+        tail = [m.group() for m in tail_matches]
+        head_matches = list(_MERGE_TOKEN_RE.finditer(text[:400]))[:MERGE_MAX_TOKENS]
+        head = [m.group() for m in head_matches]
+        k = next(
+            (k for k in range(min(len(tail), len(head)), 1, -1) if tail[-k:] == head[:k]),
+            0
+        )
+        if k:
+            merged = _append_rest(merged, text[head_matches[k - 1].end():])
+            continue
+        m = difflib.SequenceMatcher(None, tail, head, autojunk=False).find_longest_match(
+            0, len(tail), 0, len(head)
+        )
+        if (m.size >= MERGE_FUZZY_MIN and m.b <= MERGE_FUZZY_SLACK
+                and len(tail) - (m.a + m.size) <= MERGE_FUZZY_SLACK):
+            # 共通部分列より後ろは両チャンクとも境界の揺れなので、前チャンク側を切って次チャンク側を使う
+            merged = merged[:tail_matches[m.a + m.size - 1].end()]
+            merged = _append_rest(merged, text[head_matches[m.b + m.size - 1].end():])
+            continue
+        merged = f"{merged} {text}"
+    return merged
+
+
+WHISPER_CONCURRENCY = 4   # 同時に投げるWhisperリクエスト数（RPM制限対策）
+WHISPER_MAX_RETRIES = 3   # 429・接続エラー・5xx時のリトライ回数（SDK側のリトライは切っている）
+EXTRACT_CONCURRENCY = min(4, os.cpu_count() or 1)   # 同時に走らせるffmpeg切り出し数
+WHISPER_RPM = 450         # 1分あたりのリクエスト上限（OpenAIの500 RPMに余裕を持たせる）
+
+
+def _rate_limiter():
+    """分あたりのリクエスト数を抑えるトークンバケット（aiolimiterがなければ制限なし）"""
+    try:
+        from aiolimiter import AsyncLimiter
+        return AsyncLimiter(WHISPER_RPM, 60)
+    except ImportError:
+        return contextlib.nullcontext()
+
+
+class PartialTranscript(str):
+    """一部のチャンクが欠けた文字起こし。画面には出すが、キャッシュには入れない（次回は全体を再試行する）"""
+
+
+async def _split_and_transcribe_async(input_path, duration, api_key, pb) -> tuple[list[str], bool]:
+    """チャンクを切り出しながら並列に文字起こしし、元の順序のテキストと、全チャンクが成功したかを返す。
+
+    切り出し（ffmpeg -c copy）も EXTRACT_CONCURRENCY 本まで並行に走らせ、
+    切り出せたチャンクから順に送るため、分割の待ち時間がAPIの待ち時間に隠れる。
+    一部のチャンクが失敗しても残りは続行し、失敗した区間は警告に出して除いて返す。
+    """
+    windows = _chunk_windows(duration, _find_silence_cuts(input_path, duration))
+    # -c copy なのでチャンクは入力と同じコンテナ（圧縮後は.ogg）
+    src = Path(input_path)
+    sem = asyncio.Semaphore(WHISPER_CONCURRENCY)
+    extract_sem = asyncio.Semaphore(EXTRACT_CONCURRENCY)
+    # イベントループに紐づくため asyncio.run ごとに作る
+    limiter = _rate_limiter()
+    texts, failed = {}, {}
+
+    # 非同期クライアントはイベントループに紐づくため get_openai では共有せず、
+    # この asyncio.run の間だけ1つを全チャンクで使い回す
+    async with AsyncOpenAI(
+        api_key=api_key,
+        # SDK側も429を自動リトライするため、リトライは下のループ（リミッター経由）だけにする
+        max_retries=0,
+        # HTTP/2 なら並列のチャンク送信が1本のTCP接続に多重化される
+        http_client=httpx.AsyncClient(http2=_http2_available()),
+    ) as client:
+        async def _transcribe_one(idx, path):
+            try:
+                async with sem:
+                    for attempt in range(WHISPER_MAX_RETRIES + 1):
+                        try:
+                            # リトライも含めて1リクエストごとにバケットから1つ消費する
+                            async with limiter:
+                                with open(path, "rb") as f:
+                                    text = await client.audio.transcriptions.create(
+                                        model=TRANSCRIBE_MODEL,
+                                        file=f,
+                                        language="ja",
+                                        response_format="text"
+                                    )
+                            break
+                        except (RateLimitError, APIConnectionError, InternalServerError):
+                            if attempt == WHISPER_MAX_RETRIES:
+                                raise
+                            # 指数バックオフ（1, 2, 4秒 + ゆらぎ）
+                            await asyncio.sleep(2 ** attempt + random.random())
+                texts[idx] = text
+            except Exception as e:   # 1チャンクの失敗で全体を止めない
+                failed[idx] = e
+            finally:
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(path)
+            pb.progress((len(texts) + len(failed)) / len(windows))
+
+        async def _extract_and_transcribe(idx, start, length):
+            chunk = src.with_stem(f"{src.stem}_chunk{idx:03d}").as_posix()
+            try:
+                async with extract_sem:
+                    ok = await _extract_chunk(input_path, start, length, chunk)
+            except Exception as e:   # 切り出しの失敗も1チャンク分として扱い、他のチャンクは続行
+                failed[idx] = e
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(chunk)
+                pb.progress((len(texts) + len(failed)) / len(windows))
+                return
+            if ok:
+                await _transcribe_one(idx, chunk)
+
+        tasks = [asyncio.create_task(_extract_and_transcribe(i, start, length))
+                 for i, (start, length) in enumerate(windows)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for t in tasks:
+                t.cancel()
+
+    pb.progress(1.0)
+    for idx in sorted(failed):
+        start, length = windows[idx]
+        st.warning(
+            f"⚠️ チャンク{idx + 1}（{int(start) // 60}:{int(start) % 60:02d}〜"
+            f"{int(start + length) // 60}:{int(start + length) % 60:02d}）の文字起こしに失敗したため除外しました: {failed[idx]}"
+        )
+    return [texts[i] for i in sorted(texts)], not failed
+
+
+TRANSCRIBE_MAX_SEC = 1400   # gpt-4o-transcribe が1リクエストで受け付ける長さの上限（余裕込み）
+LOCAL_WHISPER_MODEL = "large-v3"
+
+
+@st.cache_resource(show_spinner="faster-whisper のモデルを読み込み中...")
+def get_local_whisper():
+    """ローカル文字起こし用モデル（int8量子化。プロセス内で1つを使い回す）"""
+    from faster_whisper import WhisperModel  # optional dependency
+    return WhisperModel(LOCAL_WHISPER_MODEL, device="auto", compute_type="int8")
+
+
+def _stream_local_transcription(model, source):
+    """faster-whisper で文字起こしし、確定したセグメントを順に返す（VAD内蔵のため分割不要）"""
+    segments, _ = model.transcribe(_rewind(source), language="ja",
+                                   vad_filter=True, beam_size=1)
+    for seg in segments:
+        yield seg.text
+
+
+def _stream_transcription(client, file):
+    """1ファイルを文字起こしし、確定したテキスト断片を順に返す"""
+    stream = client.audio.transcriptions.create(
+        model=TRANSCRIBE_MODEL,
+        file=file,
+        language="ja",
+        response_format="text",
+        stream=True
+    )
+    for event in stream:
+        if event.type == "transcript.text.delta":
+            yield event.delta
+
+
+def transcribe_audio(source, api_key, local=False):
+    """音声を文字起こし（大容量対応）
+
+    source はファイルパスかアップロードファイル（BytesIO）。
+    モデルの長さ上限に収まる音声は、ディスクを経由せずメモリ上でOpusに変換してそのまま送り、
+    結果をストリーミングで表示する。長い音声・長さが取れない音声は _transcribe_from_disk へ回す。
+    local=True なら API を使わず faster-whisper で文字起こしする（長さに関係なく分割しない）。
+    """
+    if local:
+        try:
+            model = get_local_whisper()
+        except ImportError:
+            st.error("ローカル文字起こしには faster-whisper が必要です: pip install faster-whisper")
+            return None
+        try:
+            with st.container(height=200):
+                return st.write_stream(_stream_local_transcription(model, source))
+        except Exception as e:
+            st.error(f"文字起こしエラー: {e}")
+            return None
+
+    client = get_openai(api_key)
+
+    # 録音WebMなど長さが取れない入力は変換後に判定する
+    duration, ready = _probe_audio(source)
+
+    try:
+        if duration is not None and duration <= TRANSCRIBE_MAX_SEC:
+            if ready:
+                # 既に低ビットレートのモノラル音声なので変換せずそのまま送る（上限の長さでも6MB未満）
+                name = Path(_source_name(source)).name
+                data = Path(source).read_bytes() if _is_path(source) else source.getvalue()
+            else:
+                st.info("  🔧 圧縮中...")
+                # 16kbpsなら上限の長さでも数MBで、24MBを超えることはない
+                name, data = "audio.ogg", compress_audio_to_bytes(source)
+                if data is None:
+                    return None
+            with st.container(height=200):
+                return st.write_stream(_batched(_stream_transcription(client, (name, data))))
+
+        return _transcribe_from_disk(client, source, api_key, ready, duration)
+
     except Exception as e:
         st.error(f"文字起こしエラー: {e}")
         return None
 
 
+def _transcribe_from_disk(client, source, api_key, ready=False, duration=None):
+    """Opus 16kbpsへ変換したファイルを作り、24MBまたは長さ上限を超える場合だけ分割して文字起こし
+
+    ffmpeg の分割にはパスが要るので、変換結果は一時ディレクトリに書き出す。
+    アップロードファイルは元データをディスクへコピーせず、メモリから直接変換する
+    （PyAV が無い ffmpeg は pipe:0 から読む。ただし ready でそのまま使う場合はコピーが要る）。
+    中間ファイルは一時ディレクトリごと片付く。
+    ready で元データをそのまま使う場合は、判明している duration を測り直さない。
+    """
+    with tempfile.TemporaryDirectory() as td:
+        if not ready:
+            st.info("  🔧 圧縮中...")
+            # 拡張子を.ogg（Opus）に統一
+            work_path = os.path.join(td, "work.ogg")
+            if not compress_audio(source, work_path):
+                return None
+        elif _is_path(source):
+            work_path = os.fspath(source)
+        else:
+            work_path = os.path.join(td, f"upload{Path(source.name).suffix}")
+            with open(work_path, "wb") as f:
+                shutil.copyfileobj(_rewind(source), f, length=1024 * 1024)
+        return _split_or_stream(client, work_path, api_key, duration if ready else None)
+
+
+def _split_or_stream(client, work_path, api_key, duration=None):
+    """24MBまたは長さ上限を超えるなら分割して並列に、収まるならそのまま1回で文字起こし"""
+    max_size = 24 * 1024 * 1024
+    if duration is None:
+        duration = _probe_duration(work_path)
+    if os.path.getsize(work_path) > max_size or duration > TRANSCRIBE_MAX_SEC:
+        # 分割（切り出しと文字起こしを並行）
+        st.info("  ✂️ 分割しながら文字起こし中...")
+        pb = st.progress(0)
+        try:
+            texts, complete = asyncio.run(
+                _split_and_transcribe_async(work_path, duration, api_key, pb)
+            )
+        except subprocess.CalledProcessError as e:
+            st.error(f"分割エラー: {_ffmpeg_error(e)}")
+            return None
+        if not texts:
+            return None
+        merged = merge_overlapping(texts)
+        return merged if complete else PartialTranscript(merged)
+
+    with open(work_path, "rb") as f, st.container(height=200):
+        return st.write_stream(_batched(_stream_transcription(client, f)))
+
+
+def transcribe_audio_cached(source, api_key, local=False):
+    """同じ内容の音声ファイルは再度APIに送らずキャッシュから返す"""
+    digest = (_file_digest(source) if _is_path(source)
+              else hashlib.sha256(source.getbuffer()).hexdigest())
+    backend = f"local-{LOCAL_WHISPER_MODEL}" if local else TRANSCRIBE_MODEL
+    key = f"tr:{backend}:{_api_key_fp(api_key)}:{digest}"
+    cached = _store_get(key)
+    if cached is not None:
+        return cached
+    text = transcribe_audio(source, api_key, local=local)
+    # 失敗も、一部のチャンクが欠けた結果もキャッシュしない
+    if text is not None and not isinstance(text, PartialTranscript):
+        _store_put(key, text)
+    return text
+
+
 # ═══════════════════════════════════════════
 # 資料テキスト抽出
 # ═══════════════════════════════════════════
+PDF_MIN_TEXT_CHARS = 100   # これ以上のテキストが取れたら残りの抽出器は試さない
+
+
+# MuPDF・PDFium はライブラリ全体で状態を共有しており、別の文書でも複数スレッドから同時に呼べない。
+# 資料はスレッドプールで並行に解析するので、ネイティブの抽出器は1本ずつ通す
+_NATIVE_PDF_LOCK = threading.Lock()
+
+
+def _pdf_text_fitz(file_path):
+    import fitz  # optional dependency (PyMuPDF)
+    with _NATIVE_PDF_LOCK:
+        opened = fitz.open(file_path) if _is_path(file_path) else fitz.open(stream=file_path, filetype="pdf")
+        with opened as doc:
+            return "\n".join(page.get_text("text") for page in doc)
+
+
+def _pdf_text_pdfium(file_path):
+    import pypdfium2 as pdfium  # optional dependency
+    with _NATIVE_PDF_LOCK:
+        pdf = pdfium.PdfDocument(file_path)
+        try:
+            texts = []
+            for page in pdf:
+                textpage = page.get_textpage()
+                texts.append(textpage.get_text_range())
+                textpage.close()
+                page.close()
+            return "\n".join(texts)
+        finally:
+            pdf.close()
+
+
+def _pdf_text_pypdf(file_path):
+    from pypdf import PdfReader
+    reader = PdfReader(file_path)
+    return "\n".join(p.extract_text() or "" for p in reader.pages)
+
+
+def _pdf_text_pdfplumber(file_path):
+    # レイアウト解析をするぶん遅いので最後の手段
+    import pdfplumber
+    texts = []
+    with pdfplumber.open(file_path) as pdf:
+        for page in pdf.pages:
+            t = page.extract_text()
+            if t:
+                texts.append(t)
+    return "\n".join(texts)
+
+
 def extract_pdf_text(file_path):
-    try:
-        import pdfplumber
-        texts = []
-        with pdfplumber.open(file_path) as pdf:
-            for page in pdf.pages:
-                t = page.extract_text()
-                if t:
-                    texts.append(t)
-        return "\n".join(texts)
-    except Exception:
+    """速い抽出器から順に試し、十分なテキストが取れた時点で返す"""
+    best, last_error = "", None
+    for backend in (_pdf_text_fitz, _pdf_text_pdfium, _pdf_text_pypdf, _pdf_text_pdfplumber):
         try:
-            from pypdf import PdfReader
-            reader = PdfReader(file_path)
-            return "\n".join(p.extract_text() or "" for p in reader.pages)
-        except Exception as e:
-            return f"[PDF読み取りエラー: {e}]"
+            text = backend(_rewind(file_path))
+        except Exception as e:   # 未インストール（ImportError）も含めて次へ
+            last_error = e
+            continue
+        if len(text.strip()) > PDF_MIN_TEXT_CHARS:
+            return text
+        if len(text.strip()) > len(best.strip()):
+            best = text
+    if best or last_error is None:
+        return best
+    return f"[PDF読み取りエラー: {last_error}]"
 
 
 def extract_pptx_text(file_path):
@@ -249,21 +978,39 @@ def extract_docx_text(file_path):
 
 
 def extract_material_text(uploaded_file):
+    # どのパーサもファイルオブジェクトを読めるので、一時ファイルに書かずアップロードのバッファから直接読む
     suffix = Path(uploaded_file.name).suffix.lower()
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as f:
-        f.write(uploaded_file.read())
-        tmp = f.name
-    try:
-        if suffix == ".pdf":
-            return extract_pdf_text(tmp)
-        elif suffix in [".pptx", ".ppt"]:
-            return extract_pptx_text(tmp)
-        elif suffix in [".docx", ".doc"]:
-            return extract_docx_text(tmp)
-        return f"[未対応形式: {suffix}]"
-    finally:
-        if os.path.exists(tmp):
-            os.remove(tmp)
+    source = _rewind(uploaded_file)
+    if suffix == ".pdf":
+        return extract_pdf_text(source)
+    elif suffix in [".pptx", ".ppt"]:
+        return extract_pptx_text(source)
+    elif suffix in [".docx", ".doc"]:
+        return extract_docx_text(source)
+    return f"[未対応形式: {suffix}]"
+
+
+MATERIAL_WORKERS = min(os.cpu_count() or 1, 4)   # 解析はCPU寄りなのでコア数を超えて並べない
+
+
+@st.cache_data(show_spinner=False, max_entries=50)
+def _extract_materials_cached(file_keys: tuple, _files: list) -> list:
+    """file_keys（拡張子・内容ハッシュ）が同じならキャッシュから返す。_files はハッシュ対象外"""
+    if len(_files) == 1:
+        return [extract_material_text(_files[0])]
+    # 各ファイルの解析は独立なので並行に行う（警告の表示は呼び出し側のメインスレッドで）。
+    # PPTX・DOCX・pypdf は並行に進み、PyMuPDF/PDFium の区間だけ _NATIVE_PDF_LOCK で直列になる
+    with ThreadPoolExecutor(max_workers=min(MATERIAL_WORKERS, len(_files))) as ex:
+        return list(ex.map(extract_material_text, _files))
+
+
+def extract_materials(uploaded_files) -> list:
+    """複数の資料からテキストを抽出（同じ資料での再実行はPDF等を解析し直さない）"""
+    file_keys = tuple(
+        (Path(f.name).suffix.lower(), hashlib.sha256(f.getbuffer()).hexdigest())
+        for f in uploaded_files
+    )
+    return _extract_materials_cached(file_keys, list(uploaded_files))
 
 
 # ═══════════════════════════════════════════
@@ -323,7 +1070,8 @@ def _youtube_whisper_fallback(url: str, video_id: str) -> tuple:
             api_key = st.session_state.get("api_key", "")
             if not api_key:
                 return None, "音声ダウンロード成功しましたが OpenAI API キーがないため Whisper 文字起こしができません"
-            transcript = transcribe_audio(audio_path, api_key)
+            transcript = transcribe_audio(audio_path, api_key,
+                                          local=st.session_state.get("local_whisper", False))
             if transcript:
                 st.success(f"✅ Whisper フォールバック成功（{len(transcript):,}文字）")
                 return transcript, video_id
@@ -442,21 +1190,28 @@ def extract_title_from_report(report: str) -> str:
     return "音声メモレポート"
 
 
+_TAG_SPLIT_RE = re.compile(r'[、,，　 ]+')
+
+
 def extract_tags_from_report(report: str) -> list[str]:
     for line in report.splitlines():
         line = line.strip()
-        if line.startswith("> タグ：") or line.startswith("> タグ:"):
-            tags_str = re.sub(r'^> タグ[：:]', '', line).strip()
-            return [t.strip() for t in re.split(r'[、,，　 ]+', tags_str) if t.strip()]
+        # 接頭辞は判定済みなので、もう一度正規表現で消さずに長さ分を切り落とす
+        if line.startswith(("> タグ：", "> タグ:")):
+            tags_str = line[len("> タグ："):].strip()
+            return [t for t in _TAG_SPLIT_RE.split(tags_str) if t]
     return []
 
 
 # ═══════════════════════════════════════════
 # Markmap生成
 # ═══════════════════════════════════════════
+MARKMAP_INPUT_TOKENS = 3000   # Markmap生成に渡すレポートの上限
+
+
 def generate_markmap(report: str, api_key: str) -> str | None:
     """PLAUDレポートからMarkmap用Markdown見出し構造を生成"""
-    client = OpenAI(api_key=api_key)
+    client = get_openai(api_key)
     try:
         resp = client.chat.completions.create(
             model="gpt-4o",
@@ -470,7 +1225,7 @@ def generate_markmap(report: str, api_key: str) -> str | None:
 - 深さは最大3階層
 
 レポート（抜粋）:
-{report[:5000]}"""}
+{truncate_tokens(report, MARKMAP_INPUT_TOKENS)}"""}
             ],
             temperature=0.3,
             max_tokens=800,
@@ -480,6 +1235,7 @@ def generate_markmap(report: str, api_key: str) -> str | None:
         return None
 
 
+@st.cache_data(show_spinner=False, max_entries=32)
 def render_markmap_html(markmap_md: str) -> str:
     return f"""<!DOCTYPE html>
 <html>
@@ -549,31 +1305,33 @@ def _code_block(content: str, language: str = "markdown") -> dict:
             "code": {"rich_text": _rich_text(content[:2000]), "language": language}}
 
 
+# 行頭の記法（見出し / 番号付き / 箇条書き / 引用）を1回のマッチで取り出す
+_MD_LINE_RE = re.compile(r"^(#{1,3} |\d+\. |[-*] |> )(.*)$")
+# 記法 → ブロック生成関数（表にない記法は番号付きリスト）
+_MD_MARKER_BLOCKS = {
+    "# ": lambda t: _heading_block(1, t),
+    "## ": lambda t: _heading_block(2, t),
+    "### ": lambda t: _heading_block(3, t),
+    "- ": _bulleted_block,
+    "* ": _bulleted_block,
+    "> ": _quote_block,
+}
+# インラインの `code` / **bold** / *italic* をまとめて外す
+_MD_INLINE_RE = re.compile(r"`([^`]+)`|\*\*([^*]+)\*\*|\*([^*]+)\*")
+
+
 def markdown_to_notion_blocks(md: str) -> list:
     """マークダウン文字列をNotionブロックリストに変換"""
     blocks = []
     for line in md.splitlines():
-        if line.startswith("# "):
-            blocks.append(_heading_block(1, line[2:].strip()))
-        elif line.startswith("## "):
-            blocks.append(_heading_block(2, line[3:].strip()))
-        elif line.startswith("### "):
-            blocks.append(_heading_block(3, line[4:].strip()))
-        elif re.match(r'^\d+\. ', line):
-            text = re.sub(r'^\d+\. ', '', line).strip()
-            blocks.append(_numbered_block(text))
-        elif line.startswith("- ") or line.startswith("* "):
-            text = line[2:].strip()
-            blocks.append(_bulleted_block(text))
-        elif line.startswith("> "):
-            text = line[2:].strip()
-            blocks.append(_quote_block(text))
+        m = _MD_LINE_RE.match(line)
+        if m:
+            marker, text = m.groups()
+            blocks.append(_MD_MARKER_BLOCKS.get(marker, _numbered_block)(text.strip()))
         elif line.strip() == "---":
             blocks.append(_divider_block())
         elif line.strip():
-            text = re.sub(r'`([^`]+)`', r'\1', line)
-            text = re.sub(r'\*\*([^*]+)\*\*', r'\1', text)
-            text = re.sub(r'\*([^*]+)\*', r'\1', text)
+            text = _MD_INLINE_RE.sub(lambda mm: mm.group(mm.lastindex), line)
             blocks.append(_paragraph_block(text))
     return blocks
 
@@ -742,34 +1500,103 @@ def save_to_notion_kenshu(
 # ═══════════════════════════════════════════
 # GPT：Plaud風レポート
 # ═══════════════════════════════════════════
-def generate_report(combined_transcript, file_labels, material_text, api_key):
-    client = OpenAI(api_key=api_key)
-
-    # ── 入力テキストを制限内に収める ──
-    safe_transcript = combined_transcript[:MAX_TRANSCRIPT_CHARS]
-    if len(combined_transcript) > MAX_TRANSCRIPT_CHARS:
-        st.info(f"📝 レポート生成のため文字起こしを {MAX_TRANSCRIPT_CHARS:,}文字に調整しました（元: {len(combined_transcript):,}文字）")
-
-    safe_material = ""
-    if material_text and material_text.strip():
-        safe_material = f"""
----
-【補足資料】
-{material_text[:MAX_MATERIAL_CHARS]}
----
-上記資料の数値・固有名詞・用語を積極的に活用してください。
-"""
-
-    files_note = (
-        f"※ 本レポートは以下 {len(file_labels)} 件の音声ファイルを統合した内容です：\n"
-        + "\n".join(f"  - {l}" for l in file_labels)
-    ) if len(file_labels) > 1 else ""
-
-    prompt = f"""以下の音声文字起こしを全て読み込み、PLAUD形式の詳細レポートを日本語で作成してください。
+STREAM_BATCH = 32   # 画面を更新するまでにまとめる断片（≒トークン）数
+
+
+def _batched(deltas, n: int = STREAM_BATCH):
+    """ストリームの断片を n 個ずつまとめて返す（st.write_stream が毎トークン再描画しないように）"""
+    buf = []
+    for d in deltas:
+        buf.append(d)
+        if len(buf) >= n:
+            yield "".join(buf)
+            buf = []
+    if buf:
+        yield "".join(buf)
+
+
+def _iter_report_deltas(stream, finish_reasons: list):
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        choice = chunk.choices[0]
+        if choice.finish_reason:
+            finish_reasons.append(choice.finish_reason)
+        yield choice.delta.content or ""
+
+
+MARKMAP_MARKER = "<!-- MARKMAP -->"   # レポートの後ろに続くMarkmap部分の区切り
+
+
+def _hide_after_marker(deltas, parts: list):
+    """全文を parts に集めつつ、MARKMAP_MARKER より前（レポート本文）だけを表示用に返す"""
+    pending, hidden = "", False
+    keep = len(MARKMAP_MARKER) - 1   # 区切りが断片をまたいでも表示しないよう末尾を保留
+    for d in deltas:
+        parts.append(d)
+        if hidden:
+            continue
+        pending += d
+        i = pending.find(MARKMAP_MARKER)
+        if i >= 0:
+            yield pending[:i]
+            hidden = True
+        elif len(pending) > keep:
+            yield pending[:-keep]
+            pending = pending[-keep:]
+    if not hidden and pending:
+        yield pending
+
+
+def split_report_markmap(text: str) -> tuple:
+    """レポート全文を (レポート本文, Markmap用Markdown または None) に分ける"""
+    report, _, markmap = text.partition(MARKMAP_MARKER)
+    return report.rstrip(), (markmap.strip() or None)
+
+
+def _stream_report(messages, api_key, model=REPORT_MODEL) -> str:
+    """レポートをストリーミングで画面に書き出し、全文（Markmap部分を含む）を返す。
+
+    同一プロンプト（モデル・プロンプト版・APIキー込みのハッシュ）はキャッシュから返す。
+    st.cache_data はストリーミング表示を記録できないため、_response_store に保存する。
+    """
+    key = hashlib.sha256(
+        json.dumps([model, PROMPT_VERSION, _api_key_fp(api_key), messages],
+                   ensure_ascii=False).encode()
+    ).hexdigest()
+    cached = _store_get(key)
+    if cached is not None:
+        st.markdown(split_report_markmap(cached)[0])
+        return cached
+
+    client = get_openai(api_key)
+    stream = client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=0.3,
+        max_tokens=REPORT_MAX_TOKENS,
+        stream=True
+    )
+    finish_reasons, parts = [], []
+    st.write_stream(_batched(
+        _hide_after_marker(_iter_report_deltas(stream, finish_reasons), parts)
+    ))
+    text = "".join(parts)
+    if "length" in finish_reasons:
+        st.warning("⚠️ 出力上限に達したため、レポート末尾が途切れている可能性があります。")
+    _store_put(key, text)
+    return text
+
+
+# プロンプトは固定文字列としてモジュールに置き、呼び出しごとに .format で差し込む。
+# 内容を変えたら PROMPT_VERSION を上げること（レポートキャッシュのキーに含まれる）。
+_PLAUD_SYSTEM_PROMPT = "あなたは音声メモからPLAUD形式の高品質な構造化レポートを作成する専門家です。指定されたフォーマットに厳密に従い、文字起こしの内容を網羅的に整理してください。"
+
+_PLAUD_PROMPT_TEMPLATE = """以下の音声文字起こしを全て読み込み、PLAUD形式の詳細レポートを日本語で作成してください。
 {files_note}
-{safe_material}
+{material}
 【文字起こし】
-{safe_transcript}
+{transcript}
 
 ---
 
@@ -824,35 +1651,61 @@ def generate_report(combined_transcript, file_labels, material_text, api_key):
 - ハイライトは文字起こしの原文を一字一句そのまま引用すること
 - 章とトピックは文字起こしの話題の流れに沿って分割すること
 - 宿題と提案は会話中に明示的に出てきたアクションのみ記載すること
-- 全て日本語で出力すること"""
+- 全て日本語で出力すること
+
+レポートの後に次の1行を出力し、続けてレポート全体をMarkmap形式のMarkdown見出し構造に変換したものを出力してください。
+{marker}
+- 見出し（# ## ###）のみ使用
+- 各ノードは短いキーワード（15文字以内）
+- コードブロック不要、見出しのみ出力
+- 深さは最大3階層"""
+
+
+def generate_report(combined_transcript, file_labels, material_text, api_key, model=REPORT_MODEL):
+    """PLAUDレポートを生成する。Markmapも同じ呼び出しで末尾に出力させる（split_report_markmap で分ける）"""
+    # ── 入力テキストを制限内に収める ──
+    safe_transcript = combined_transcript[:MAX_TRANSCRIPT_CHARS]
+    if len(combined_transcript) > MAX_TRANSCRIPT_CHARS:
+        st.info(f"📝 レポート生成のため文字起こしを {MAX_TRANSCRIPT_CHARS:,}文字に調整しました（元: {len(combined_transcript):,}文字）")
+
+    safe_material = ""
+    if material_text and material_text.strip():
+        safe_material = f"""
+---
+【補足資料】
+{material_text[:MAX_MATERIAL_CHARS]}
+---
+上記資料の数値・固有名詞・用語を積極的に活用してください。
+"""
+
+    files_note = (
+        f"※ 本レポートは以下 {len(file_labels)} 件の音声ファイルを統合した内容です：\n"
+        + "\n".join(f"  - {l}" for l in file_labels)
+    ) if len(file_labels) > 1 else ""
+
+    prompt = _PLAUD_PROMPT_TEMPLATE.format(
+        files_note=files_note, material=safe_material, transcript=safe_transcript,
+        marker=MARKMAP_MARKER
+    )
 
     try:
-        resp = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "あなたは音声メモからPLAUD形式の高品質な構造化レポートを作成する専門家です。指定されたフォーマットに厳密に従い、文字起こしの内容を網羅的に整理してください。"},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.3,
-            max_tokens=4000
-        )
-        return resp.choices[0].message.content
+        return _stream_report([
+            {"role": "system", "content": _PLAUD_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ], api_key, model)
     except Exception as e:
         error_str = str(e)
         if "rate_limit_exceeded" in error_str or "too large" in error_str.lower():
             st.warning("⚠️ テキストが長すぎるため、さらに短縮して再試行します...")
             short_transcript = combined_transcript[:6000]
             try:
-                resp2 = client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[
-                        {"role": "system", "content": "あなたは音声メモからPLAUD形式の高品質な構造化レポートを作成する専門家です。指定されたフォーマットに厳密に従い、文字起こしの内容を網羅的に整理してください。"},
-                        {"role": "user", "content": prompt.replace(safe_transcript, short_transcript)}
-                    ],
-                    temperature=0.3,
-                    max_tokens=4000
-                )
-                return resp2.choices[0].message.content
+                return _stream_report([
+                    {"role": "system", "content": _PLAUD_SYSTEM_PROMPT},
+                    {"role": "user", "content": _PLAUD_PROMPT_TEMPLATE.format(
+                        files_note=files_note, material=safe_material, transcript=short_transcript,
+                        marker=MARKMAP_MARKER
+                    )}
+                ], api_key, model)
             except Exception as e2:
                 st.error(f"レポート生成エラー（再試行後）: {e2}")
                 return None
@@ -863,54 +1716,72 @@ def generate_report(combined_transcript, file_labels, material_text, api_key):
 # ═══════════════════════════════════════════
 # GPT：構造化サマリー（JSON）
 # ═══════════════════════════════════════════
-def generate_summary_json(combined_transcript, report, material_text, api_key):
-    client = OpenAI(api_key=api_key)
+class FlowItem(BaseModel):
+    time: str = Field(description="序盤 / 中盤 / 終盤 など")
+    topic: str = Field(description="トピック名")
+    summary: str = Field(description="内容の要約（30〜60文字）")
 
-    # ── 入力を制限 ──
-    safe_transcript = combined_transcript[:6000]
-    safe_report     = report[:MAX_REPORT_CHARS]
-    mat_note = "補足資料の情報も反映してください。" if material_text else ""
 
-    prompt = f"""以下の音声文字起こしとレポートから、構造化サマリーをJSON形式で作成してください。{mat_note}
+class TitledItem(BaseModel):
+    title: str
+    detail: str = Field(description="詳細説明")
 
-【文字起こし（抜粋）】
-{safe_transcript}
 
+class ActionItem(BaseModel):
+    priority: Literal["高", "中", "低"]
+    who: str = Field(description="担当者")
+    what: str = Field(description="タスク内容")
+    when: str = Field(description="期限")
+
+
+class KeyNumber(BaseModel):
+    label: str = Field(description="指標名・数値名")
+    value: str = Field(description="具体的な数値・データ")
+
+
+class SummaryData(BaseModel):
+    title: str = Field(description="会議・メモのタイトル（15〜30文字）")
+    date: str = Field(description="推定日付または「不明」")
+    type: str = Field(description="会議 / 1on1 / ブレスト / 講義 / その他")
+    duration: str = Field(description="推定XX分")
+    urgency: Literal["高", "中", "低"]
+    one_line: str = Field(description="この会議・メモを一文で表すと（30〜50文字）")
+    participants: list[str]
+    flow: list[FlowItem] = Field(description="話の流れ（序盤・中盤・終盤など3項目程度）")
+    decisions: list[TitledItem]
+    actions: list[ActionItem]
+    concerns: list[TitledItem]
+    next_topics: list[str] = Field(description="次回以降の検討事項")
+    key_numbers: list[KeyNumber]
+    keywords: list[str] = Field(description="重要キーワード5個程度")
+
+
+def request_summary_json(combined_transcript, report, material_text, api_key):
+    """構造化サマリーを生成して dict を返す（UIに触れないのでスレッドから呼べる。失敗は例外）
+
+    report が空なら文字起こし（と資料の抜粋）だけから作る（レポート生成と並行に走らせるため）。
+    """
+    client = get_openai(api_key)
+
+    # ── 入力を制限 ──
+    safe_transcript = truncate_tokens(combined_transcript, SUMMARY_TRANSCRIPT_TOKENS)
+    report_section = f"""
 【レポート（抜粋）】
-{safe_report}
-
-以下のJSON構造で出力してください（日本語で）。
-コードブロック（```）は使わず、JSONのみを出力してください。
-
-{{
-  "title": "会議・メモのタイトル（15〜30文字）",
-  "date": "推定日付または「不明」",
-  "type": "会議 / 1on1 / ブレスト / 講義 / その他",
-  "duration": "推定XX分",
-  "urgency": "高 / 中 / 低",
-  "one_line": "この会議・メモを一文で表すと（30〜50文字）",
-  "participants": ["参加者1", "参加者2"],
-  "flow": [
-    {{"time": "序盤", "topic": "トピック名", "summary": "内容の要約（30〜60文字）"}},
-    {{"time": "中盤", "topic": "トピック名", "summary": "内容の要約（30〜60文字）"}},
-    {{"time": "終盤", "topic": "トピック名", "summary": "内容の要約（30〜60文字）"}}
-  ],
-  "decisions": [
-    {{"title": "決定事項名", "detail": "詳細説明"}}
-  ],
-  "actions": [
-    {{"priority": "高/中/低", "who": "担当者", "what": "タスク内容", "when": "期限"}}
-  ],
-  "concerns": [
-    {{"title": "懸念・リスク名", "detail": "詳細説明"}}
-  ],
-  "next_topics": ["次回以降の検討事項1", "次回以降の検討事項2"],
-  "key_numbers": [
-    {{"label": "指標名・数値名", "value": "具体的な数値・データ"}}
-  ],
-  "keywords": ["重要キーワード1", "重要キーワード2", "重要キーワード3", "重要キーワード4", "重要キーワード5"]
-}}
+{truncate_tokens(report, MAX_REPORT_TOKENS)}
+""" if report else ""
+    # レポートを待たない下書きでも資料の情報が入るよう、資料の抜粋は常に渡す
+    material_section = f"""
+【補足資料（抜粋）】
+{truncate_tokens(material_text, SUMMARY_MATERIAL_TOKENS)}
+""" if material_text and material_text.strip() else ""
+    source_note = "音声文字起こしとレポート" if report else "音声文字起こし"
+    mat_note = "補足資料の数値・固有名詞も反映してください。" if material_section else ""
+
+    prompt = f"""以下の{source_note}から、構造化サマリーを日本語で作成してください。{mat_note}
 
+【文字起こし（抜粋）】
+{safe_transcript}
+{report_section}{material_section}
 注意：
 - decisionsは実際に決定したことのみ。なければ空配列[]
 - actionsは具体的なタスク。なければ空配列[]
@@ -918,18 +1789,35 @@ def generate_summary_json(combined_transcript, report, material_text, api_key):
 - key_numbersは具体的な数値が言及された場合のみ。なければ空配列[]
 """
 
-    try:
-        resp = client.chat.completions.create(
+    messages = [
+        {"role": "system", "content": "あなたは会議の内容を正確に構造化するアナリストです。"},
+        {"role": "user", "content": prompt}
+    ]
+    key = "summary:" + hashlib.sha256(
+        json.dumps(["gpt-4o", PROMPT_VERSION, _api_key_fp(api_key), messages],
+                   ensure_ascii=False).encode()
+    ).hexdigest()
+    content = _store_get(key)
+    if content is None:
+        # スキーマはAPI側で強制されるので、プロンプトにJSONの雛形を書かない
+        resp = client.beta.chat.completions.parse(
             model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "あなたは会議の内容を正確に構造化するアナリストです。指示通りのJSONのみを出力します。"},
-                {"role": "user", "content": prompt}
-            ],
+            messages=messages,
             temperature=0.2,
             max_tokens=2000,
-            response_format={"type": "json_object"}
+            response_format=SummaryData
         )
-        return json.loads(resp.choices[0].message.content)
+        message = resp.choices[0].message
+        if message.parsed is None:
+            raise ValueError(message.refusal or "構造化サマリーを取得できませんでした")
+        _store_put(key, message.content)
+        return message.parsed.model_dump()
+    return json.loads(content)
+
+
+def generate_summary_json(combined_transcript, report, material_text, api_key):
+    try:
+        return request_summary_json(combined_transcript, report, material_text, api_key)
     except Exception as e:
         st.error(f"構造化サマリー生成エラー: {e}")
         return None
@@ -938,60 +1826,154 @@ def generate_summary_json(combined_transcript, report, material_text, api_key):
 # ═══════════════════════════════════════════
 # 構造化サマリー → HTML
 # ═══════════════════════════════════════════
+_PRIORITY_COLOR = {"高": "#e53e5a", "中": "#f5a623", "低": "#22c38e"}
+_PRIORITY_RANK = {"高": 0, "中": 1, "低": 2}
+_URGENCY_COLORS = {"高": ("#e53e5a", "#fff0f2"), "中": ("#f5a623", "#fff8ee"), "低": ("#22c38e", "#f0fff8")}
+_URGENCY_ICON = {"高": "🔴", "中": "🟡"}
+# 欠けた項目の既定値（キャッシュ済みの古いサマリーはスキーマ導入前で項目が揃っていないことがある）
+_SUMMARY_DEFAULTS = {
+    "title": "構造化サマリー", "date": "不明", "type": "会議", "duration": "不明",
+    "urgency": "中", "one_line": "", "participants": [], "flow": [], "decisions": [],
+    "actions": [], "concerns": [], "next_topics": [], "key_numbers": [], "keywords": [],
+}
+# 一覧項目ごとの既定値（スキーマで生成した新しい結果には全キーが揃っている）
+_SUMMARY_ITEM_DEFAULTS = {
+    "flow": {"time": "", "topic": "", "summary": ""},
+    "decisions": {"title": "", "detail": ""},
+    "actions": {"priority": "中", "what": "", "who": "未定", "when": "期限未定"},
+    "concerns": {"title": "", "detail": ""},
+    "key_numbers": {"label": "", "value": ""},
+}
+
+
+def _fill_summary_defaults(data):
+    """トップレベルと一覧項目の欠けたキーを一度に埋める（以降は添字で読める）"""
+    filled = {**_SUMMARY_DEFAULTS, **data}
+    for field, item_defaults in _SUMMARY_ITEM_DEFAULTS.items():
+        filled[field] = [{**item_defaults, **item} for item in filled[field]]
+    return filled
+
+
+_SUMMARY_CSS = """@import url('https://fonts.googleapis.com/css2?family=Noto+Sans+JP:wght@300;400;500;700;900&display=swap');
+:root {
+  --ink:#1a2140;--ink2:#4a567a;--ink3:#8892b0;
+  --line:#e2e8f0;--bg:#f8faff;--card:#ffffff;
+  --blue:#3b6ef0;--blue-lt:#eef2ff;
+  --green:#22c38e;--red:#e53e5a;--amber:#f5a623;
+  --radius:10px;--shadow:0 2px 12px rgba(26,33,64,.08);
+}
+*{box-sizing:border-box;margin:0;padding:0;}
+body{font-family:'Noto Sans JP',sans-serif;background:var(--bg);color:var(--ink);font-size:14px;line-height:1.7;}
+.page{max-width:860px;margin:0 auto;padding:40px 32px 80px;}
+.doc-header{border-bottom:3px solid var(--blue);padding-bottom:24px;margin-bottom:32px;}
+.doc-meta{display:flex;gap:10px;flex-wrap:wrap;margin-bottom:12px;}
+.meta-chip{display:inline-flex;align-items:center;gap:5px;font-size:11px;font-weight:600;letter-spacing:.06em;color:var(--ink3);background:white;border:1px solid var(--line);border-radius:99px;padding:3px 11px;}
+.doc-title{font-size:clamp(20px,3vw,28px);font-weight:900;color:var(--ink);line-height:1.3;margin-bottom:12px;}
+.one-line{font-size:14px;color:var(--ink2);background:var(--blue-lt);border-left:4px solid var(--blue);padding:10px 16px;border-radius:0 8px 8px 0;font-weight:500;}
+.urgency-badge{display:inline-flex;align-items:center;gap:5px;font-size:12px;font-weight:700;padding:4px 14px;border-radius:99px;border:1.5px solid;margin-top:12px;}
+.kpi-row{display:flex;gap:12px;flex-wrap:wrap;margin-bottom:32px;}
+.kpi-card{background:var(--card);border:1px solid var(--line);border-radius:var(--radius);padding:16px 20px;min-width:120px;text-align:center;box-shadow:var(--shadow);flex:1;}
+.kpi-value{font-size:22px;font-weight:900;color:var(--blue);line-height:1.2;}
+.kpi-label{font-size:11px;color:var(--ink3);margin-top:4px;}
+.section{margin-bottom:32px;}
+.section-title{font-size:11px;font-weight:800;letter-spacing:.14em;text-transform:uppercase;color:var(--blue);margin-bottom:12px;display:flex;align-items:center;gap:8px;}
+.section-title::after{content:'';flex:1;height:1px;background:var(--line);}
+.flow-wrap{display:flex;flex-direction:column;}
+.flow-item{display:flex;gap:16px;align-items:flex-start;background:var(--card);border:1px solid var(--line);border-radius:var(--radius);padding:14px 18px;width:100%;box-shadow:var(--shadow);}
+.flow-arrow{text-align:center;color:var(--ink3);font-size:18px;padding:4px 0;}
+.flow-time{font-size:11px;font-weight:700;color:var(--blue);background:var(--blue-lt);padding:3px 10px;border-radius:99px;white-space:nowrap;flex-shrink:0;align-self:flex-start;margin-top:2px;}
+.flow-topic{font-size:14px;font-weight:700;color:var(--ink);margin-bottom:4px;}
+.flow-summary{font-size:13px;color:var(--ink2);}
+.card-item{background:var(--card);border-radius:var(--radius);padding:14px 18px;margin-bottom:10px;border:1px solid var(--line);box-shadow:var(--shadow);}
+.card-decision{border-left:4px solid var(--green);}
+.card-concern{border-left:4px solid var(--amber);}
+.card-item-title{font-size:14px;font-weight:700;color:var(--ink);margin-bottom:4px;}
+.card-item-detail{font-size:13px;color:var(--ink2);}
+.action-row{display:flex;gap:14px;align-items:flex-start;background:var(--card);border:1px solid var(--line);border-radius:var(--radius);padding:12px 16px;margin-bottom:8px;box-shadow:var(--shadow);}
+.action-priority{font-size:11px;font-weight:700;padding:3px 10px;border-radius:99px;white-space:nowrap;flex-shrink:0;}
+.action-what{font-size:14px;font-weight:600;color:var(--ink);margin-bottom:4px;}
+.action-meta{font-size:12px;color:var(--ink3);}
+.next-list{list-style:none;display:flex;flex-direction:column;gap:8px;}
+.next-list li{background:var(--card);border:1px solid var(--line);border-radius:var(--radius);padding:10px 16px;font-size:13px;color:var(--ink2);box-shadow:var(--shadow);}
+.next-list li::before{content:"→ ";color:var(--blue);font-weight:700;}
+.keyword-wrap{display:flex;flex-wrap:wrap;gap:8px;}
+.keyword{background:var(--blue-lt);color:var(--blue);border:1px solid #c0cef8;border-radius:99px;padding:4px 14px;font-size:12px;font-weight:600;}
+.two-col{display:grid;grid-template-columns:1fr 1fr;gap:24px;}
+.empty-note{font-size:13px;color:var(--ink3);font-style:italic;padding:8px 4px;}
+.doc-footer{margin-top:48px;padding-top:16px;border-top:1px solid var(--line);font-size:11px;color:var(--ink3);}
+.files-note{font-size:12px;color:var(--ink3);margin-top:4px;}
+@media(max-width:600px){.page{padding:24px 16px 60px;}.two-col{grid-template-columns:1fr;}}
+@media print{body{background:white;}.page{padding:20px;max-width:100%;}.card-item,.action-row,.flow-item,.next-list li{-webkit-print-color-adjust:exact;print-color-adjust:exact;break-inside:avoid;}.section{break-inside:avoid;}}
+"""
+
+
+def _escape_tree(value):
+    """JSON由来の値に含まれる文字列をすべてHTMLエスケープする（LLMの出力をそのまま埋め込まないため）"""
+    if isinstance(value, str):
+        return html.escape(value)
+    if isinstance(value, dict):
+        return {k: _escape_tree(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_escape_tree(v) for v in value]
+    return value
+
+
 def summary_to_html(data, file_labels, generated_at):
-    urgency_color = {"高": "#e53e5a", "中": "#f5a623", "低": "#22c38e"}.get(data.get("urgency", "中"), "#888")
-    urgency_bg    = {"高": "#fff0f2", "中": "#fff8ee", "低": "#f0fff8"}.get(data.get("urgency", "中"), "#f5f5f5")
-
-    flow_items = data.get("flow", [])
-    flow_html = ""
-    for i, f in enumerate(flow_items):
-        connector = '<div class="flow-arrow">↓</div>' if i < len(flow_items) - 1 else ""
-        flow_html += f"""
+    data = _escape_tree(_fill_summary_defaults(data))
+    file_labels = [html.escape(l) for l in file_labels]
+    urgency_color, urgency_bg = _URGENCY_COLORS.get(data["urgency"], ("#888", "#f5f5f5"))
+
+    flow_items = data["flow"]
+    # 項目の間にだけ矢印を挟む
+    flow_html = '<div class="flow-arrow">↓</div>'.join(
+        f"""
         <div class="flow-item">
-          <div class="flow-time">{f.get('time','')}</div>
+          <div class="flow-time">{f['time']}</div>
           <div class="flow-content">
-            <div class="flow-topic">{f.get('topic','')}</div>
-            <div class="flow-summary">{f.get('summary','')}</div>
+            <div class="flow-topic">{f['topic']}</div>
+            <div class="flow-summary">{f['summary']}</div>
           </div>
-        </div>{connector}"""
+        </div>"""
+        for f in flow_items
+    )
 
-    decisions = data.get("decisions", [])
+    decisions = data["decisions"]
     dec_html = "".join(
-        f'<div class="card-item card-decision"><div class="card-item-title">✅ {d.get("title","")}</div><div class="card-item-detail">{d.get("detail","")}</div></div>'
+        f'<div class="card-item card-decision"><div class="card-item-title">✅ {d["title"]}</div><div class="card-item-detail">{d["detail"]}</div></div>'
         for d in decisions
     ) if decisions else '<div class="empty-note">言及なし</div>'
 
-    actions = data.get("actions", [])
-    pc_map = {"高": "#e53e5a", "中": "#f5a623", "低": "#22c38e"}
-    act_html = "".join(
-        f'''<div class="action-row">
-          <span class="action-priority" style="background:{pc_map.get(a.get("priority","中"),"#888")}20;color:{pc_map.get(a.get("priority","中"),"#888")};border:1px solid {pc_map.get(a.get("priority","中"),"#888")}40">{a.get("priority","")}</span>
+    actions = data["actions"]
+    act_rows = []
+    for a in sorted(actions, key=lambda x: _PRIORITY_RANK.get(x["priority"], 1)):
+        pc = _PRIORITY_COLOR.get(a["priority"], "#888")
+        act_rows.append(f'''<div class="action-row">
+          <span class="action-priority" style="background:{pc}20;color:{pc};border:1px solid {pc}40">{a["priority"]}</span>
           <div class="action-body">
-            <div class="action-what">{a.get("what","")}</div>
-            <div class="action-meta">👤 {a.get("who","未定")} &nbsp;｜&nbsp; 📅 {a.get("when","期限未定")}</div>
+            <div class="action-what">{a["what"]}</div>
+            <div class="action-meta">👤 {a["who"]} &nbsp;｜&nbsp; 📅 {a["when"]}</div>
           </div>
-        </div>'''
-        for a in sorted(actions, key=lambda x: {"高":0,"中":1,"低":2}.get(x.get("priority","中"),1))
-    ) if actions else '<div class="empty-note">言及なし</div>'
+        </div>''')
+    act_html = "".join(act_rows) if actions else '<div class="empty-note">言及なし</div>'
 
-    concerns = data.get("concerns", [])
+    concerns = data["concerns"]
     con_html = "".join(
-        f'<div class="card-item card-concern"><div class="card-item-title">⚠️ {c.get("title","")}</div><div class="card-item-detail">{c.get("detail","")}</div></div>'
+        f'<div class="card-item card-concern"><div class="card-item-title">⚠️ {c["title"]}</div><div class="card-item-detail">{c["detail"]}</div></div>'
         for c in concerns
     ) if concerns else '<div class="empty-note">言及なし</div>'
 
-    nexts = data.get("next_topics", [])
+    nexts = data["next_topics"]
     next_html = "".join(f"<li>{n}</li>" for n in nexts) if nexts else '<li class="empty-note">言及なし</li>'
 
-    nums = data.get("key_numbers", [])
+    nums = data["key_numbers"]
     num_html = "".join(
-        f'<div class="kpi-card"><div class="kpi-value">{n.get("value","")}</div><div class="kpi-label">{n.get("label","")}</div></div>'
+        f'<div class="kpi-card"><div class="kpi-value">{n["value"]}</div><div class="kpi-label">{n["label"]}</div></div>'
         for n in nums
     )
 
-    keywords = data.get("keywords", [])
+    keywords = data["keywords"]
     kw_html = "".join(f'<span class="keyword">{k}</span>' for k in keywords)
-    participants = data.get("participants", [])
+    participants = data["participants"]
     par_html = "・".join(participants) if participants else "不明"
     files_html = "・".join(file_labels)
 
@@ -1000,72 +1982,23 @@ def summary_to_html(data, file_labels, generated_at):
 <head>
 <meta charset="UTF-8">
 <meta name="viewport" content="width=device-width,initial-scale=1">
-<title>{data.get('title','構造化サマリー')}</title>
+<title>{data['title']}</title>
 <style>
-@import url('https://fonts.googleapis.com/css2?family=Noto+Sans+JP:wght@300;400;500;700;900&display=swap');
-:root {{
-  --ink:#1a2140;--ink2:#4a567a;--ink3:#8892b0;
-  --line:#e2e8f0;--bg:#f8faff;--card:#ffffff;
-  --blue:#3b6ef0;--blue-lt:#eef2ff;
-  --green:#22c38e;--red:#e53e5a;--amber:#f5a623;
-  --radius:10px;--shadow:0 2px 12px rgba(26,33,64,.08);
-}}
-*{{box-sizing:border-box;margin:0;padding:0;}}
-body{{font-family:'Noto Sans JP',sans-serif;background:var(--bg);color:var(--ink);font-size:14px;line-height:1.7;}}
-.page{{max-width:860px;margin:0 auto;padding:40px 32px 80px;}}
-.doc-header{{border-bottom:3px solid var(--blue);padding-bottom:24px;margin-bottom:32px;}}
-.doc-meta{{display:flex;gap:10px;flex-wrap:wrap;margin-bottom:12px;}}
-.meta-chip{{display:inline-flex;align-items:center;gap:5px;font-size:11px;font-weight:600;letter-spacing:.06em;color:var(--ink3);background:white;border:1px solid var(--line);border-radius:99px;padding:3px 11px;}}
-.doc-title{{font-size:clamp(20px,3vw,28px);font-weight:900;color:var(--ink);line-height:1.3;margin-bottom:12px;}}
-.one-line{{font-size:14px;color:var(--ink2);background:var(--blue-lt);border-left:4px solid var(--blue);padding:10px 16px;border-radius:0 8px 8px 0;font-weight:500;}}
-.urgency-badge{{display:inline-flex;align-items:center;gap:5px;font-size:12px;font-weight:700;padding:4px 14px;border-radius:99px;background:{urgency_bg};color:{urgency_color};border:1.5px solid {urgency_color}40;margin-top:12px;}}
-.kpi-row{{display:flex;gap:12px;flex-wrap:wrap;margin-bottom:32px;}}
-.kpi-card{{background:var(--card);border:1px solid var(--line);border-radius:var(--radius);padding:16px 20px;min-width:120px;text-align:center;box-shadow:var(--shadow);flex:1;}}
-.kpi-value{{font-size:22px;font-weight:900;color:var(--blue);line-height:1.2;}}
-.kpi-label{{font-size:11px;color:var(--ink3);margin-top:4px;}}
-.section{{margin-bottom:32px;}}
-.section-title{{font-size:11px;font-weight:800;letter-spacing:.14em;text-transform:uppercase;color:var(--blue);margin-bottom:12px;display:flex;align-items:center;gap:8px;}}
-.section-title::after{{content:'';flex:1;height:1px;background:var(--line);}}
-.flow-wrap{{display:flex;flex-direction:column;}}
-.flow-item{{display:flex;gap:16px;align-items:flex-start;background:var(--card);border:1px solid var(--line);border-radius:var(--radius);padding:14px 18px;width:100%;box-shadow:var(--shadow);}}
-.flow-arrow{{text-align:center;color:var(--ink3);font-size:18px;padding:4px 0;}}
-.flow-time{{font-size:11px;font-weight:700;color:var(--blue);background:var(--blue-lt);padding:3px 10px;border-radius:99px;white-space:nowrap;flex-shrink:0;align-self:flex-start;margin-top:2px;}}
-.flow-topic{{font-size:14px;font-weight:700;color:var(--ink);margin-bottom:4px;}}
-.flow-summary{{font-size:13px;color:var(--ink2);}}
-.card-item{{background:var(--card);border-radius:var(--radius);padding:14px 18px;margin-bottom:10px;border:1px solid var(--line);box-shadow:var(--shadow);}}
-.card-decision{{border-left:4px solid var(--green);}}
-.card-concern{{border-left:4px solid var(--amber);}}
-.card-item-title{{font-size:14px;font-weight:700;color:var(--ink);margin-bottom:4px;}}
-.card-item-detail{{font-size:13px;color:var(--ink2);}}
-.action-row{{display:flex;gap:14px;align-items:flex-start;background:var(--card);border:1px solid var(--line);border-radius:var(--radius);padding:12px 16px;margin-bottom:8px;box-shadow:var(--shadow);}}
-.action-priority{{font-size:11px;font-weight:700;padding:3px 10px;border-radius:99px;white-space:nowrap;flex-shrink:0;}}
-.action-what{{font-size:14px;font-weight:600;color:var(--ink);margin-bottom:4px;}}
-.action-meta{{font-size:12px;color:var(--ink3);}}
-.next-list{{list-style:none;display:flex;flex-direction:column;gap:8px;}}
-.next-list li{{background:var(--card);border:1px solid var(--line);border-radius:var(--radius);padding:10px 16px;font-size:13px;color:var(--ink2);box-shadow:var(--shadow);}}
-.next-list li::before{{content:"→ ";color:var(--blue);font-weight:700;}}
-.keyword-wrap{{display:flex;flex-wrap:wrap;gap:8px;}}
-.keyword{{background:var(--blue-lt);color:var(--blue);border:1px solid #c0cef8;border-radius:99px;padding:4px 14px;font-size:12px;font-weight:600;}}
-.two-col{{display:grid;grid-template-columns:1fr 1fr;gap:24px;}}
-.empty-note{{font-size:13px;color:var(--ink3);font-style:italic;padding:8px 4px;}}
-.doc-footer{{margin-top:48px;padding-top:16px;border-top:1px solid var(--line);font-size:11px;color:var(--ink3);}}
-.files-note{{font-size:12px;color:var(--ink3);margin-top:4px;}}
-@media(max-width:600px){{.page{{padding:24px 16px 60px;}}.two-col{{grid-template-columns:1fr;}}}}
-@media print{{body{{background:white;}}.page{{padding:20px;max-width:100%;}}.card-item,.action-row,.flow-item,.next-list li{{-webkit-print-color-adjust:exact;print-color-adjust:exact;break-inside:avoid;}}.section{{break-inside:avoid;}}}}
+{_SUMMARY_CSS}.urgency-badge{{background:{urgency_bg};color:{urgency_color};border-color:{urgency_color}40;}}
 </style>
 </head>
 <body>
 <div class="page">
   <div class="doc-header">
     <div class="doc-meta">
-      <span class="meta-chip">📅 {data.get('date','不明')}</span>
-      <span class="meta-chip">🎙️ {data.get('type','会議')}</span>
-      <span class="meta-chip">⏱ {data.get('duration','不明')}</span>
+      <span class="meta-chip">📅 {data['date']}</span>
+      <span class="meta-chip">🎙️ {data['type']}</span>
+      <span class="meta-chip">⏱ {data['duration']}</span>
       <span class="meta-chip">👥 {par_html}</span>
     </div>
-    <div class="doc-title">{data.get('title','構造化サマリー')}</div>
-    <div class="one-line">{data.get('one_line','')}</div>
-    <div class="urgency-badge">{'🔴' if data.get('urgency')=='高' else '🟡' if data.get('urgency')=='中' else '🟢'} 緊急度：{data.get('urgency','中')}</div>
+    <div class="doc-title">{data['title']}</div>
+    <div class="one-line">{data['one_line']}</div>
+    <div class="urgency-badge">{_URGENCY_ICON.get(data['urgency'], '🟢')} 緊急度：{data['urgency']}</div>
     <div class="files-note">📁 対象ファイル：{files_html}</div>
   </div>
   {"<div class='kpi-row'>" + num_html + "</div>" if nums else ""}
@@ -1098,6 +2031,29 @@ body{{font-family:'Noto Sans JP',sans-serif;background:var(--bg);color:var(--ink
 </html>"""
 
 
+# ═══════════════════════════════════════════
+# 音声ファイルの並び順
+# ═══════════════════════════════════════════
+_NUM_SPLIT_RE = re.compile(r"(\d+)")
+
+
+@functools.lru_cache(maxsize=512)
+def _natural_key(name):
+    """ファイル名を文字部分と数字部分に分け、数字は整数として比べる（録音の連番を 2 < 10 の順に並べる）
+
+    拡張子（.mp3 の3、.m4a の4）は連番ではないので、拡張子を除いた部分だけを見る。
+    「meeting」「meeting 2」のように連番なしの名前は、同じ名前の連番付きより前に来る。
+    """
+    parts = _NUM_SPLIT_RE.split(Path(name).stem)
+    # split の結果は 文字, 数字, 文字, ... の順に並ぶので、同じ位置どうしは常に同じ型で比べられる
+    key = tuple(int(p) if i % 2 else p.casefold() for i, p in enumerate(parts))
+    return key, name
+
+
+def _audio_sort_key(f):
+    return _natural_key(f.name)
+
+
 # ═══════════════════════════════════════════
 # UI：サイドバー
 # ═══════════════════════════════════════════
@@ -1115,6 +2071,16 @@ with st.sidebar:
             st.session_state.api_key = api_key_input
             st.success("✓ APIキー設定済み")
 
+    st.toggle(
+        "⚡ 高速モード（gpt-4o-mini）", key="fast_mode",
+        help="レポート生成を gpt-4o-mini で行います。速く安価ですが、内容の細かさは gpt-4o に劣ります。"
+    )
+    st.toggle(
+        "🖥️ ローカル文字起こし（faster-whisper）", key="local_whisper",
+        help="音声をAPIに送らず、このサーバー上の faster-whisper で文字起こしします。"
+             "`pip install faster-whisper` が必要です。GPUがない環境では時間がかかります。"
+    )
+
     if NOTION_API_KEY:
         st.success("✓ Notion APIキー設定済み")
     else:
@@ -1229,10 +2195,7 @@ has_input = bool(audio_files or youtube_url.strip() or text_files or pasted_text
 
 if has_input:
     if audio_files:
-        def sort_key(f):
-            nums = re.findall(r'\d+', f.name)
-            return "".join(nums).zfill(20) if nums else f.name
-        sorted_audio = sorted(audio_files, key=sort_key)
+        sorted_audio = sorted(audio_files, key=_audio_sort_key)
 
         with st.expander(f"📋 音声ファイル {len(sorted_audio)}件", expanded=True):
             for i, f in enumerate(sorted_audio, 1):
@@ -1268,9 +2231,9 @@ if has_input:
         combined_material = None
         if material_files:
             with st.spinner("📄 補足資料を読み込み中..."):
+                extracted = extract_materials(material_files)
                 mat_texts = []
-                for mf in material_files:
-                    t = extract_material_text(mf)
+                for mf, t in zip(material_files, extracted):
                     if t and not t.startswith("["):
                         mat_texts.append(f"=== {mf.name} ===\n{t}")
                     else:
@@ -1288,43 +2251,40 @@ if has_input:
 
         if source_type == "🎵 音声ファイル":
             source_label = "音声"
-            st.markdown("### 🎧 STEP1：文字起こし")
-            all_tmp_paths = []
-            for idx, audio_file in enumerate(sorted_audio):
-                st.markdown(f"**[{idx+1}/{len(sorted_audio)}]** {audio_file.name}")
-                suffix = Path(audio_file.name).suffix
-                with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as f:
-                    f.write(audio_file.read())
-                    tmp_path = f.name
-                    all_tmp_paths.append(tmp_path)
-                with st.spinner("  文字起こし中..."):
-                    tr = transcribe_audio(tmp_path, st.session_state.api_key)
-                if tr:
-                    transcripts_per_file[audio_file.name] = tr
-                    st.success(f"  ✅ 完了（{len(tr):,}文字）")
-                else:
-                    st.error("  ❌ 失敗")
-            for p in all_tmp_paths:
-                if os.path.exists(p):
-                    os.remove(p)
-            if not transcripts_per_file:
-                st.error("文字起こしに成功したファイルがありません。")
-                st.stop()
-            file_labels = list(transcripts_per_file.keys())
-            raw_transcript = (
-                list(transcripts_per_file.values())[0]
-                if len(file_labels) == 1
-                else "\n\n".join(f"--- {k} ---\n{v}" for k, v in transcripts_per_file.items())
-            )
-            st.success(f"✅ 文字起こし完了（合計 {len(raw_transcript):,}文字）")
+            # アップロードはメモリ上のまま渡す（長い音声だけ transcribe_audio が一時ディレクトリへ書き出す）
+            with st.status("🎧 STEP1：文字起こし", expanded=True) as status:
+                for idx, audio_file in enumerate(sorted_audio):
+                    status.update(label=f"🎧 STEP1：文字起こし [{idx+1}/{len(sorted_audio)}] {audio_file.name}")
+                    st.markdown(f"**[{idx+1}/{len(sorted_audio)}]** {audio_file.name}")
+                    tr = transcribe_audio_cached(audio_file, st.session_state.api_key,
+                                                 local=st.session_state.get("local_whisper", False))
+                    if tr:
+                        transcripts_per_file[audio_file.name] = tr
+                        st.success(f"  ✅ 完了（{len(tr):,}文字）")
+                    else:
+                        st.error("  ❌ 失敗")
+                if not transcripts_per_file:
+                    status.update(label="❌ 文字起こしに成功したファイルがありません", state="error")
+                    st.stop()
+                file_labels = list(transcripts_per_file.keys())
+                raw_transcript = (
+                    list(transcripts_per_file.values())[0]
+                    if len(file_labels) == 1
+                    else "\n\n".join(f"--- {k} ---\n{v}" for k, v in transcripts_per_file.items())
+                )
+                status.update(label=f"✅ 文字起こし完了（合計 {len(raw_transcript):,}文字）",
+                              state="complete", expanded=False)
 
         elif source_type == "🎬 YouTube URL":
             source_label = "YouTube"
-            st.markdown("### 🎬 STEP1：YouTube字幕取得")
-            with st.spinner("字幕を取得中..."):
+            with st.status("🎬 STEP1：YouTube字幕取得", expanded=True) as status:
                 raw_transcript, video_id = get_youtube_transcript(youtube_url.strip())
+                if raw_transcript:
+                    status.update(label=f"✅ 字幕取得完了（{len(raw_transcript):,}文字）",
+                                  state="complete", expanded=False)
+                else:
+                    status.update(label="❌ 取得失敗", state="error")
             if not raw_transcript:
-                st.error(f"❌ 取得失敗")
                 # video_id には失敗理由が入っている
                 for line in video_id.splitlines():
                     st.error(line)
@@ -1344,7 +2304,6 @@ if has_input:
                 st.stop()
             file_labels = [youtube_url.strip()]
             transcripts_per_file = {youtube_url.strip(): raw_transcript}
-            st.success(f"✅ 字幕取得完了（{len(raw_transcript):,}文字）")
 
         elif source_type == "📝 テキストファイル":
             source_label = "テキスト"
@@ -1373,42 +2332,68 @@ if has_input:
         # ── 長文圧縮 ──
         if len(raw_transcript) > MAX_TRANSCRIPT_CHARS:
             st.info(f"📝 テキストが長いため圧縮します（{len(raw_transcript):,}文字）...")
-            with st.spinner("圧縮中..."):
+            with st.status("📝 テキスト圧縮中...") as status:
                 combined_transcript = compress_transcript(raw_transcript, st.session_state.api_key)
+                status.update(label=f"✅ テキスト圧縮完了（{len(combined_transcript):,}文字）",
+                              state="complete")
         else:
             combined_transcript = raw_transcript
 
-        # ── STEP 2：PLAUDレポート生成 ──
-        st.markdown("### 📊 STEP2：PLAUDレポート生成")
-        with st.spinner("GPT-4o でレポート生成中..."):
-            report = generate_report(
-                combined_transcript, file_labels, combined_material, st.session_state.api_key
+        # ── STEP 2〜4：レポート・Markmap・構造化サマリー ──
+        # 構造化サマリーは文字起こしと資料の抜粋から下書きできるので、レポートのストリーミング中に
+        # 別スレッドで並行に生成する（UI更新はメインスレッドだけで行う）
+        get_openai(st.session_state.api_key)   # スレッドから使う前にクライアントを作っておく
+        with ThreadPoolExecutor(max_workers=2) as ex:
+            summary_future = ex.submit(
+                request_summary_json, combined_transcript, "", combined_material,
+                st.session_state.api_key
             )
-        if not report:
-            st.error("レポート生成に失敗しました。")
-            st.stop()
-        st.success(f"✅ レポート完了{'（資料補完あり）' if combined_material else ''}")
-
-        # ── STEP 3：Markmap生成 ──
-        st.markdown("### 🗺️ STEP3：マインドマップ生成")
-        with st.spinner("Markmap生成中..."):
-            markmap_md = generate_markmap(report, st.session_state.api_key)
-        if markmap_md:
-            st.success("✅ マインドマップ生成完了")
-        else:
-            st.warning("⚠️ マインドマップ生成に失敗しました")
 
-        # ── STEP 4：構造化サマリー生成 ──
-        st.markdown("### 📋 STEP4：構造化サマリー生成")
-        with st.spinner("構造化サマリー生成中..."):
-            summary_data = generate_summary_json(
-                combined_transcript, report, combined_material, st.session_state.api_key
+            report_model = FAST_REPORT_MODEL if st.session_state.get("fast_mode") else REPORT_MODEL
+            with st.status(f"📊 STEP2：PLAUDレポート生成中（{report_model}）", expanded=True) as status:
+                report_text = generate_report(
+                    combined_transcript, file_labels, combined_material,
+                    st.session_state.api_key, model=report_model
+                )
+                if not report_text:
+                    status.update(label="❌ レポート生成に失敗しました", state="error")
+                    st.stop()
+                report, markmap_md = split_report_markmap(report_text)
+                status.update(label=f"✅ レポート完了{'（資料補完あり）' if combined_material else ''}",
+                              state="complete", expanded=False)
+
+            # Markmapは通常レポートと同じ呼び出しで届く。欠けていた場合だけ別途生成する
+            markmap_future = (
+                None if markmap_md
+                else ex.submit(generate_markmap, report, st.session_state.api_key)
             )
-        summary_html = None
-        if summary_data:
-            generated_at = datetime.now().strftime("%Y-%m-%d %H:%M")
-            summary_html = summary_to_html(summary_data, file_labels, generated_at)
-            st.success("✅ 構造化サマリー完了")
+            markmap_status = st.status("🗺️ STEP3：マインドマップ生成中")
+
+            with st.status("📋 STEP4：構造化サマリー生成中") as status:
+                try:
+                    summary_data = summary_future.result()
+                except Exception as e:
+                    st.warning(f"⚠️ 構造化サマリーの下書きに失敗しました: {e}")
+                    summary_data = None
+                # 下書きが失敗したか、決定事項・アクションが取れなかった場合だけレポートも渡して作り直す
+                if not summary_data or not (summary_data.get("decisions") or summary_data.get("actions")):
+                    summary_data = generate_summary_json(
+                        combined_transcript, report, combined_material, st.session_state.api_key
+                    ) or summary_data
+                summary_html = None
+                if summary_data:
+                    generated_at = datetime.now().strftime("%Y-%m-%d %H:%M")
+                    summary_html = summary_to_html(summary_data, file_labels, generated_at)
+                    status.update(label="✅ 構造化サマリー完了", state="complete")
+                else:
+                    status.update(label="⚠️ 構造化サマリー生成に失敗しました", state="error")
+
+            if markmap_future is not None:
+                markmap_md = markmap_future.result()
+        if markmap_md:
+            markmap_status.update(label="✅ マインドマップ生成完了", state="complete")
+        else:
+            markmap_status.update(label="⚠️ マインドマップ生成に失敗しました", state="error")
 
         # 結果保存
         result = {
@@ -1434,6 +2419,187 @@ if has_input:
 
 
 # ── 結果表示 ──
+# 1.52以降はdataに関数を渡すと押されたときだけ中身を作る。それより前は毎回そのまま渡す
+_DEFERRED_DOWNLOADS = Version(st.__version__) >= Version("1.52")
+
+
+def _download_data(make):
+    return make if _DEFERRED_DOWNLOADS else make()
+
+
+@functools.lru_cache(maxsize=2048)
+def _stem(name):
+    return Path(name).stem
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def gzip_html_wrap(page_html: str) -> str:
+    """HTMLをgzip+base64で埋め込み、iframe内でDecompressionStreamにより展開して表示する小さなページを返す"""
+    payload = base64.b64encode(gzip.compress(page_html.encode("utf-8"))).decode("ascii")
+    return f"""<!DOCTYPE html><html><body><script>
+(async () => {{
+  const bytes = Uint8Array.from(atob("{payload}"), c => c.charCodeAt(0));
+  const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream("gzip"));
+  const page = await new Response(stream).text();
+  document.open(); document.write(page); document.close();
+}})();
+</script></body></html>"""
+
+
+def _bundle_zip(result):
+    """ファイル別・結合の文字起こしと、あればレポート類を1つのZIPにまとめる"""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED, compresslevel=6) as z:
+        for fname, tr in result["transcripts_per_file"].items():
+            z.writestr(f"transcript_{_stem(fname)}.txt", tr)
+        z.writestr("transcript_combined.txt", result["combined_transcript"])
+        if result.get("report"):
+            z.writestr("report.md", result["report"])
+        if result.get("markmap_md"):
+            z.writestr("markmap.md", result["markmap_md"])
+        if result.get("summary_html"):
+            z.writestr("summary.html", result["summary_html"])
+    return buf.getvalue()
+
+
+def _show_transcript(text, height, parent=st):
+    # 読み取り専用なのでtext_areaの編集状態を持たせず、コピーボタン付きのコードブロックで出す
+    parent.container(height=height).code(text, language=None, wrap_lines=True)
+
+
+@st.fragment
+def _render_result(result):
+    """履歴の1件を描画する。fragmentなので中のボタン操作で他の結果まで再実行しない"""
+    mat_badge = "  📎 資料補完あり" if result["has_material"] else ""
+    labels = result["file_labels"]
+    n_files = len(labels)
+    date_key = result["date"]
+    date_slug = date_key.replace(":", "").replace(" ", "_")
+    fname_base = _stem(labels[0]) if n_files == 1 else f"combined_{date_slug}"
+    merged_badge = f"[{n_files}件統合] " if n_files > 1 else ""
+    header_label = f"📁 {merged_badge}{result['label']}  —  {date_key}{mat_badge}"
+    # 空白だけのレポート・サマリーはボタンやタブを作らない
+    has_report = bool((r := result.get("report")) and r.strip())
+    has_summary = bool((h := result.get("summary_html")) and h.strip())
+
+    with st.expander(header_label, expanded=True):
+        tab_labels = ["📄 文字起こし", "📊 レポート"]
+        if result.get("markmap_md"):
+            tab_labels.append("🗺️ マインドマップ")
+        if has_summary:
+            tab_labels.append("📋 構造化サマリー")
+        tabs = st.tabs(tab_labels)
+
+        # 文字起こし
+        with tabs[0]:
+            items = tuple(result["transcripts_per_file"].items())
+            if n_files > 1:
+                sub_tabs = st.tabs([fname for fname, _ in items] + ["📄 全文（結合）"])
+                for c, (fname, tr) in zip(sub_tabs, items):
+                    _show_transcript(tr, 220, c)
+                    c.download_button(
+                        f"📥 {fname} (.txt)",
+                        _download_data(lambda tr=tr: tr),
+                        file_name=f"transcript_{_stem(fname)}.txt",
+                        mime="text/plain",
+                        key=f"dtr_{date_key}_{fname}"
+                    )
+                _show_transcript(result["combined_transcript"], 300, sub_tabs[-1])
+                sub_tabs[-1].download_button(
+                    "📥 全文字起こし（結合）(.txt)",
+                    _download_data(lambda r=result: r["combined_transcript"]),
+                    file_name=f"transcript_combined_{date_slug}.txt",
+                    mime="text/plain",
+                    key=f"dtr_all_{date_key}"
+                )
+                st.download_button(
+                    "📦 一括DL (.zip)",
+                    _download_data(lambda r=result: _bundle_zip(r)),
+                    file_name=f"bundle_{fname_base}.zip",
+                    mime="application/zip",
+                    key=f"dzip_{date_key}"
+                )
+            else:
+                fname, tr = items[0]
+                _show_transcript(tr, 250)
+                st.download_button(
+                    "📥 文字起こし (.txt)",
+                    _download_data(lambda tr=tr: tr),
+                    file_name=f"transcript_{_stem(fname)}.txt",
+                    mime="text/plain",
+                    key=f"dtr_{date_key}_{fname}"
+                )
+
+        # レポート
+        with tabs[1]:
+            if has_report:
+                st.markdown(r)
+                dl_col, notion_col = st.columns([1, 1])
+                with dl_col:
+                    st.download_button(
+                        "📥 レポート (.md)",
+                        _download_data(lambda r=result: r["report"]),
+                        file_name=f"report_{fname_base}.md",
+                        mime="text/markdown",
+                        key=f"drp_{date_key}",
+                    )
+                with notion_col:
+                    if st.button("☁️ Notionに保存", key=f"notion_{date_key}",
+                                 disabled=not NOTION_API_KEY):
+                        title = extract_title_from_report(result["report"])
+                        tags  = extract_tags_from_report(result["report"])
+                        summary_text = "\n".join(result["report"].splitlines()[:10])
+                        # source_info: ファイル名またはURL一覧
+                        src_info = labels
+                        if result.get("youtube_url"):
+                            src_info = [result["youtube_url"]]
+                        save_to_notion_kenshu(
+                            title=title,
+                            tags=tags,
+                            source_type=result.get("source_label", "音声"),
+                            report=result["report"],
+                            summary=summary_text,
+                            transcript=result.get("combined_transcript", ""),
+                            markmap_md=result.get("markmap_md", ""),
+                            summary_data=result.get("summary_data"),
+                            source_info=src_info,
+                            attachment_file_info=result.get("attachment_file_info", []),
+                        )
+                if not NOTION_API_KEY:
+                    st.caption("⚠️ NOTION_API_KEY 未設定のため保存不可")
+
+        # マインドマップ
+        tab_idx = 2
+        if result.get("markmap_md"):
+            with tabs[tab_idx]:
+                st.caption("💡 マウスホイールでズーム、ドラッグで移動できます。")
+                mm_html = render_markmap_html(result["markmap_md"])
+                st.components.v1.html(mm_html, height=560, scrolling=False)
+                st.download_button(
+                    "📥 Markmap (.md)",
+                    _download_data(lambda r=result: r["markmap_md"]),
+                    file_name=f"markmap_{fname_base}.md",
+                    mime="text/markdown",
+                    key=f"dmm_{date_key}",
+                )
+            tab_idx += 1
+
+        # 構造化サマリー
+        if has_summary:
+            with tabs[tab_idx]:
+                st.info("💡 HTMLをダウンロードしてブラウザで開くと、見やすく印刷・PDF化できます。")
+                st.download_button(
+                    "📥 構造化サマリー (.html)",
+                    _download_data(lambda r=result: r["summary_html"].encode("utf-8")),
+                    file_name=f"summary_{fname_base}.html",
+                    mime="text/html",
+                    key=f"dsum_{date_key}",
+                )
+                # 折りたたんだexpanderでも中身は毎回送られるので、オンのときだけ描画する
+                if st.toggle("🔍 プレビュー（アプリ内）", key=f"prev_{date_key}"):
+                    st.components.v1.html(gzip_html_wrap(h), height=800, scrolling=True)
+
+
 if st.session_state.results:
     st.markdown("---")
     hcol1, hcol2 = st.columns([4, 1])
@@ -1443,136 +2609,7 @@ if st.session_state.results:
         st.rerun()
 
     for result in st.session_state.results:
-        mat_badge = "  📎 資料補完あり" if result["has_material"] else ""
-        n_files = len(result["file_labels"])
-        header_label = (
-            f"📁 [{n_files}件統合] {result['label']}  —  {result['date']}{mat_badge}"
-            if n_files > 1
-            else f"📁 {result['label']}  —  {result['date']}{mat_badge}"
-        )
-
-        with st.expander(header_label, expanded=True):
-            tab_labels = ["📄 文字起こし", "📊 レポート"]
-            if result.get("markmap_md"):
-                tab_labels.append("🗺️ マインドマップ")
-            if result.get("summary_html"):
-                tab_labels.append("📋 構造化サマリー")
-            tabs = st.tabs(tab_labels)
-
-            # 文字起こし
-            with tabs[0]:
-                if n_files > 1:
-                    sub_labels = list(result["transcripts_per_file"].keys()) + ["📄 全文（結合）"]
-                    sub_tabs = st.tabs(sub_labels)
-                    for i, (fname, tr) in enumerate(result["transcripts_per_file"].items()):
-                        with sub_tabs[i]:
-                            st.text_area("", tr, height=220,
-                                         key=f"tr_{result['date']}_{fname}")
-                            st.download_button(
-                                f"📥 {fname} (.txt)",
-                                tr,
-                                file_name=f"transcript_{Path(fname).stem}.txt",
-                                mime="text/plain",
-                                key=f"dtr_{result['date']}_{fname}"
-                            )
-                    with sub_tabs[-1]:
-                        st.text_area("", result["combined_transcript"], height=300,
-                                     key=f"tr_all_{result['date']}")
-                        st.download_button(
-                            "📥 全文字起こし（結合）(.txt)",
-                            result["combined_transcript"],
-                            file_name=f"transcript_combined_{result['date'].replace(':','').replace(' ','_')}.txt",
-                            mime="text/plain",
-                            key=f"dtr_all_{result['date']}"
-                        )
-                else:
-                    fname = result["file_labels"][0]
-                    tr = result["transcripts_per_file"][fname]
-                    st.text_area("", tr, height=250,
-                                 key=f"tr_{result['date']}_{fname}")
-                    st.download_button(
-                        "📥 文字起こし (.txt)",
-                        tr,
-                        file_name=f"transcript_{Path(fname).stem}.txt",
-                        mime="text/plain",
-                        key=f"dtr_{result['date']}_{fname}"
-                    )
-
-            # レポート
-            with tabs[1]:
-                if result["report"]:
-                    st.markdown(result["report"])
-                    fname_base = (
-                        Path(result["file_labels"][0]).stem if n_files == 1
-                        else f"combined_{result['date'].replace(':','').replace(' ','_')}"
-                    )
-                    dl_col, notion_col = st.columns([1, 1])
-                    with dl_col:
-                        st.download_button(
-                            "📥 レポート (.md)",
-                            result["report"],
-                            file_name=f"report_{fname_base}.md",
-                            mime="text/markdown",
-                            key=f"drp_{result['date']}",
-                        )
-                    with notion_col:
-                        if st.button("☁️ Notionに保存", key=f"notion_{result['date']}",
-                                     disabled=not NOTION_API_KEY):
-                            title = extract_title_from_report(result["report"])
-                            tags  = extract_tags_from_report(result["report"])
-                            summary_text = "\n".join(result["report"].splitlines()[:10])
-                            # source_info: ファイル名またはURL一覧
-                            src_info = result.get("file_labels", [])
-                            if result.get("youtube_url"):
-                                src_info = [result["youtube_url"]]
-                            save_to_notion_kenshu(
-                                title=title,
-                                tags=tags,
-                                source_type=result.get("source_label", "音声"),
-                                report=result["report"],
-                                summary=summary_text,
-                                transcript=result.get("combined_transcript", ""),
-                                markmap_md=result.get("markmap_md", ""),
-                                summary_data=result.get("summary_data"),
-                                source_info=src_info,
-                                attachment_file_info=result.get("attachment_file_info", []),
-                            )
-                    if not NOTION_API_KEY:
-                        st.caption("⚠️ NOTION_API_KEY 未設定のため保存不可")
-
-            # マインドマップ
-            tab_idx = 2
-            if result.get("markmap_md"):
-                with tabs[tab_idx]:
-                    st.caption("💡 マウスホイールでズーム、ドラッグで移動できます。")
-                    mm_html = render_markmap_html(result["markmap_md"])
-                    st.components.v1.html(mm_html, height=560, scrolling=False)
-                    st.download_button(
-                        "📥 Markmap (.md)",
-                        result["markmap_md"],
-                        file_name=f"markmap_{fname_base}.md",
-                        mime="text/markdown",
-                        key=f"dmm_{result['date']}",
-                    )
-                tab_idx += 1
-
-            # 構造化サマリー
-            if result.get("summary_html") and len(tabs) > tab_idx:
-                with tabs[tab_idx]:
-                    st.info("💡 HTMLをダウンロードしてブラウザで開くと、見やすく印刷・PDF化できます。")
-                    fname_base = (
-                        Path(result["file_labels"][0]).stem if n_files == 1
-                        else f"combined_{result['date'].replace(':','').replace(' ','_')}"
-                    )
-                    st.download_button(
-                        "📥 構造化サマリー (.html)",
-                        result["summary_html"],
-                        file_name=f"summary_{fname_base}.html",
-                        mime="text/html",
-                        key=f"dsum_{result['date']}",
-                    )
-                    with st.expander("🔍 プレビュー（アプリ内）"):
-                        st.components.v1.html(result["summary_html"], height=800, scrolling=True)
+        _render_result(result)
 
 st.markdown("---")
 st.caption("🎙️ 音声メモアプリ Pro ／ Powered by OpenAI Whisper & GPT-4o")